@@ -1,13 +1,124 @@
+from functools import partial
 import math
 import numpy
 import pyproj
 
+# Creating a transformation between two projections is expensive, so keep one for each pair for the whole process
+_transformers = {}
+
+# Returns a function that converts x, y[, z] scalars or numpy arrays from src_proj to dst_proj
+def get_transformer(src_proj, dst_proj):
+    key = (src_proj.srs, dst_proj.srs)
+    transformer = _transformers.get(key)
+    if transformer is None:
+        if hasattr(pyproj, 'Transformer'):
+            # pyproj 2.2 and newer, keep easting/longitude first like pyproj.transform
+            transformer = pyproj.Transformer.from_proj(src_proj, dst_proj, always_xy=True).transform
+        else:
+            transformer = partial(pyproj.transform, src_proj, dst_proj)
+        _transformers[key] = transformer
+    return transformer
+
+# Storage type for each column of point data
+# Projected coordinates need double precision, the rest are stored compactly
+point_columns = [('x', numpy.float64), ('y', numpy.float64), ('z', numpy.float32), ('intensity', numpy.uint16), ('classification', numpy.uint8)]
+
+# Groups points by square cells of cell_pixels x cell_pixels pixels so regions can be found without scanning every point
+# Points are sorted by cell, and cells are numbered row by row, so the cells along one row of the grid are one
+# contiguous run of sorted points.  A query only touches the points in the cells it overlaps.
+class RasterGridIndex:
+    def __init__(self, rows, columns, cell_pixels=64):
+        self.rows = rows
+        self.columns = columns
+        self.cell_pixels = cell_pixels
+
+        if len(rows) == 0:
+            self.grid_shape = (0, 0)
+            self.order = numpy.empty(0, numpy.int64)
+            self.starts = numpy.zeros(1, numpy.int64)
+            return
+
+        cell_rows = rows // cell_pixels
+        cell_columns = columns // cell_pixels
+        self.grid_shape = (int(numpy.amax(cell_rows))+1, int(numpy.amax(cell_columns))+1)
+        cells = cell_rows.astype(numpy.int64) * self.grid_shape[1] + cell_columns
+
+        # Stable so points within a cell stay in their original order
+        self.order = numpy.argsort(cells, kind='stable')
+        if len(rows) < 2**31:
+            self.order = self.order.astype(numpy.int32) # Half the memory for the usual case
+        # Points of cell n are order[starts[n]:starts[n+1]]
+        self.starts = numpy.zeros(self.grid_shape[0]*self.grid_shape[1]+1, numpy.int64)
+        numpy.cumsum(numpy.bincount(cells, minlength=self.grid_shape[0]*self.grid_shape[1]), out=self.starts[1:])
+
+    # Returns the sorted indices of the points with lower_row <= row < upper_row and lower_column <= column < upper_column
+    def queryRectangle(self, lower_row, upper_row, lower_column, upper_column):
+        lower_row = max(0, int(lower_row))
+        lower_column = max(0, int(lower_column))
+        upper_row = int(upper_row)
+        upper_column = int(upper_column)
+        if upper_row <= lower_row or upper_column <= lower_column or self.grid_shape[0] == 0:
+            return numpy.empty(0, numpy.int64)
+
+        first_cell_row = lower_row // self.cell_pixels
+        last_cell_row = min(self.grid_shape[0]-1, (upper_row-1) // self.cell_pixels)
+        first_cell_column = lower_column // self.cell_pixels
+        last_cell_column = min(self.grid_shape[1]-1, (upper_column-1) // self.cell_pixels)
+        if first_cell_row > last_cell_row or first_cell_column > last_cell_column:
+            return numpy.empty(0, numpy.int64)
+
+        # One run of candidates for each row of cells
+        runs = []
+        for cell_row in range(first_cell_row, last_cell_row+1):
+            start = self.starts[cell_row*self.grid_shape[1] + first_cell_column]
+            end = self.starts[cell_row*self.grid_shape[1] + last_cell_column + 1]
+            runs.append(self.order[start:end])
+        candidates = numpy.concatenate(runs)
+
+        # Only the cells on the edge of the rectangle can hold points outside it
+        rows = self.rows[candidates]
+        columns = self.columns[candidates]
+        inside = (lower_row <= rows) & (rows < upper_row) & (lower_column <= columns) & (columns < upper_column)
+        return numpy.sort(candidates[inside]).astype(numpy.int64)
+
+    # Returns the sorted indices of the points whose pixel center is inside the polygon
+    # Polygon vertices are in pixel row, column coordinates and may be fractional, uses the even-odd rule
+    def queryPolygon(self, polygon_rows, polygon_columns):
+        polygon_rows = numpy.asarray(polygon_rows, numpy.float64)
+        polygon_columns = numpy.asarray(polygon_columns, numpy.float64)
+        if len(polygon_rows) < 3:
+            return numpy.empty(0, numpy.int64)
+
+        candidates = self.queryRectangle(math.floor(numpy.amin(polygon_rows)), math.floor(numpy.amax(polygon_rows))+1, \
+                                         math.floor(numpy.amin(polygon_columns)), math.floor(numpy.amax(polygon_columns))+1)
+        if len(candidates) == 0:
+            return candidates
+        rows = self.rows[candidates] + 0.5
+        columns = self.columns[candidates] + 0.5
+
+        # Count the edges crossed by a ray from each point towards increasing columns
+        inside = numpy.zeros(len(candidates), bool)
+        previous_row = polygon_rows[-1]
+        previous_column = polygon_columns[-1]
+        for row, column in zip(polygon_rows, polygon_columns):
+            if row != previous_row:
+                crosses = (row > rows) != (previous_row > rows)
+                crossing_column = column + (rows - row) * (previous_column - column) / (previous_row - row)
+                inside ^= crosses & (columns < crossing_column)
+            previous_row = row
+            previous_column = column
+        return candidates[inside]
+
 # Class for managing the data, base coordinate frame is zero-lower left ENU
 # Geo origin is the centroid of the data
 class GeoPointCloud:
     def __init__(self):
         self._origin = None
-        self.point_matrix = None
+        self._columns = None # Arrays may be longer than the number of points to leave room to grow
+        self._size = 0
+        self._bounds = {} # Minimum and maximum of each column, updated as points are added or moved
+        self._raster_indices = {} # Pixel of each point for each image_scale, cleared when points are added or moved
+        self._grid_indices = {} # RasterGridIndex for each image_scale, cleared with the pixels
 
         self.resetProperties()
 
@@ -25,16 +136,59 @@ class GeoPointCloud:
         self._imax = None
         self._width = None
         self._height = None
-        self._count = None
 
+    # Returns a new N x 5 matrix of x, y, z, intensity, classification
+    # Prefer the individual columns for large pointclouds
     def points(self):
-        return self.point_matrix
+        if self._columns is None:
+            return None
+        return numpy.column_stack([self.column(name) for name, dtype in point_columns]).astype(numpy.float64)
+
+    def column(self, name):
+        if self._columns is None:
+            return None
+        return self._columns[name][:self._size]
+
+    # Bounds of the stored points, these don't scan the points
+    def columnMin(self, name):
+        return self._bounds[name][0]
+
+    def columnMax(self, name):
+        return self._bounds[name][1]
+
+    def _updateBounds(self, start, end):
+        for name, dtype in point_columns:
+            values = self._columns[name][start:end]
+            new_bounds = (numpy.amin(values), numpy.amax(values))
+            if name in self._bounds:
+                new_bounds = (min(self._bounds[name][0], new_bounds[0]), max(self._bounds[name][1], new_bounds[1]))
+            self._bounds[name] = new_bounds
+
+    @property
+    def x(self):
+        return self.column('x')
+
+    @property
+    def y(self):
+        return self.column('y')
+
+    @property
+    def z(self):
+        return self.column('z')
+
+    @property
+    def intensity(self):
+        return self.column('intensity')
+
+    @property
+    def classification(self):
+        return self.column('classification')
 
     # Should always be 0.0
     @property
     def xmin(self):
         if self._xmin is None:
-            self._xmin =  numpy.amin(self.point_matrix, axis=0)[0]
+            self._xmin = self.columnMin('x')
         return self._xmin
 
     @xmin.setter
@@ -44,7 +198,7 @@ class GeoPointCloud:
     @property
     def xmax(self):
         if self._xmax is None:
-            self._xmax = numpy.amax(self.point_matrix, axis=0)[0]
+            self._xmax = self.columnMax('x')
         return self._xmax
 
     @xmax.setter
@@ -55,7 +209,7 @@ class GeoPointCloud:
     @property
     def ymin(self):
         if self._ymin is None:
-            self._ymin = numpy.amin(self.point_matrix, axis=0)[1]
+            self._ymin = self.columnMin('y')
         return self._ymin
 
     @ymin.setter
@@ -65,7 +219,7 @@ class GeoPointCloud:
     @property
     def ymax(self):
         if self._ymax is None:
-            self._ymax = numpy.amax(self.point_matrix, axis=0)[1]
+            self._ymax = self.columnMax('y')
         return self._ymax
 
     @ymax.setter
@@ -75,7 +229,7 @@ class GeoPointCloud:
     @property
     def zmin(self):
         if self._zmin is None:
-            self._zmin = numpy.amin(self.point_matrix, axis=0)[2]
+            self._zmin = self.columnMin('z')
         return self._zmin
 
     @zmin.setter
@@ -85,7 +239,7 @@ class GeoPointCloud:
     @property
     def zmax(self):
         if self._zmax is None:
-            self._zmax = numpy.amax(self.point_matrix, axis=0)[2]
+            self._zmax = self.columnMax('z')
         return self._zmax
 
     @zmax.setter
@@ -95,13 +249,13 @@ class GeoPointCloud:
     @property
     def imin(self):
         if self._imin is None:
-            self._imin = numpy.amin(self.point_matrix, axis=0)[3]
+            self._imin = self.columnMin('intensity')
         return self._imin
 
     @property
     def imax(self):
         if self._imax is None:
-            self._imax = numpy.amax(self.point_matrix, axis=0)[3]
+            self._imax = self.columnMax('intensity')
         return self._imax
 
     @property
@@ -126,11 +280,7 @@ class GeoPointCloud:
 
     @property
     def count(self):
-        if not self._count:
-            if self.point_matrix is None:
-                return 0
-            self._count = len(self.point_matrix)
-        return self._count
+        return self._size
 
     @property
     def proj(self):
@@ -173,11 +323,11 @@ class GeoPointCloud:
         return (twod[0], twod[1], z)
 
     def latlonToProj(self, lat, lon):
-        return pyproj.transform(self._platlon, self.proj, lon, lat) # Lon, lat order
+        return get_transformer(self._platlon, self.proj)(float(lon), float(lat)) # Lon, lat order
 
     def projToLatLon(self, easting, northing):
         # pyroj returns easting coordinate, northing coordinate
-        lonlat = pyproj.transform(self._proj, self._platlon, easting, northing)
+        lonlat = get_transformer(self._proj, self._platlon)(float(easting), float(northing))
         return (lonlat[1], lonlat[0])
 
     def enuToLatLon(self, x, y):
@@ -199,19 +349,45 @@ class GeoPointCloud:
         row = int(y / image_scale)
         return(row, column) # Pixels always use row, column order
 
-    # Converting points to CV2 coordinates one by one is very slow
-    # Convert the entire x and y coordinates at once here
-    # Returns in ROW, COLUMN order
+    # Returns the row and column arrays of the pixel each point falls in, in the same order as the points
+    # Computed once per image_scale and shared, so don't modify them
+    # int32 holds any image index and is half the size of the default int
+    def rasterIndices(self, image_scale):
+        indices = self._raster_indices.get(image_scale)
+        if indices is None:
+            # Same truncation as enuToCV2, coordinates are never negative after removeBias
+            rows = (self.y/image_scale).astype(numpy.int32)
+            columns = (self.x/image_scale).astype(numpy.int32)
+            rows.flags.writeable = False
+            columns.flags.writeable = False
+            indices = (rows, columns)
+            self._raster_indices[image_scale] = indices
+        return indices
+
+    # Returns a RasterGridIndex of the rasterIndices at image_scale to quickly find the points in a region
+    # Built once per image_scale and kept until points are added or moved
+    def gridIndex(self, image_scale):
+        index = self._grid_indices.get(image_scale)
+        if index is None:
+            index = RasterGridIndex(*self.rasterIndices(image_scale))
+            self._grid_indices[image_scale] = index
+        return index
+
+    def _clearRasterCaches(self):
+        self._raster_indices = {}
+        self._grid_indices = {}
+
+    # Returns a new matrix in ROW, COLUMN, z, intensity, classification order
+    # float32 holds every column exactly, rows and columns are exact up to 16 million pixels
+    # Prefer rasterIndices and the individual columns, this makes a copy of everything
     def pointsAsCV2(self, image_scale):
-        points = self.points()
-
-        # Convert to image indices
-        cols = (self.point_matrix[:,0]/image_scale).astype(int)
-        rows = (self.point_matrix[:,1]/image_scale).astype(int)
+        points = numpy.empty((self.count, 5), numpy.float32)
 
-        # Switch to matrix/image order
-        points[:,0] = rows
-        points[:,1] = cols
+        # Image indices are in matrix/image order
+        points[:,0], points[:,1] = self.rasterIndices(image_scale)
+        points[:,2] = self.z
+        points[:,3] = self.intensity
+        points[:,4] = self.classification
 
         return points
 
@@ -275,39 +451,141 @@ class GeoPointCloud:
         enu = self.latlonToENU(lat, lon)
         return self.enuToTGC(enu[0]+offset_x, enu[1]+offset_y, 0.0)
 
-    def addDataSet(self, newX, newY, newZ, newI, newC):
-        newstack = numpy.array((newX, newY, newZ, newI, newC)).transpose()
-        if self.point_matrix is None:
-            self.point_matrix = newstack
+    # Array versions of the conversions above
+    # These take numpy arrays (or lists) and return a tuple of numpy arrays in the same order as the single coordinate versions
+    # Converting thousands of coordinates in one call is much faster than one at a time
+    def latlonToProjArray(self, lat, lon):
+        return get_transformer(self._platlon, self._proj)(numpy.asarray(lon, numpy.float64), numpy.asarray(lat, numpy.float64)) # Lon, lat order
+
+    def projToLatLonArray(self, easting, northing):
+        lon, lat = get_transformer(self._proj, self._platlon)(numpy.asarray(easting, numpy.float64), numpy.asarray(northing, numpy.float64))
+        return (lat, lon)
+
+    def projToENUArray(self, easting, northing):
+        return (numpy.asarray(easting) - self._origin[0], numpy.asarray(northing) - self._origin[1])
+
+    def enuToProjArray(self, x, y):
+        return (numpy.asarray(x) + self._origin[0], numpy.asarray(y) + self._origin[1])
+
+    def latlonToENUArray(self, lat, lon):
+        return self.projToENUArray(*self.latlonToProjArray(lat, lon))
+
+    def enuToLatLonArray(self, x, y):
+        return self.projToLatLonArray(*self.enuToProjArray(x, y))
+
+    @staticmethod
+    def enuToCV2Array(x, y, image_scale):
+        # astype(int) truncates like int() does for a single coordinate
+        column = (numpy.asarray(x) / image_scale).astype(int)
+        row = (numpy.asarray(y) / image_scale).astype(int)
+        return (row, column)
+
+    @staticmethod
+    def cv2ToENUArray(row, column, image_scale):
+        return ((numpy.asarray(column) + 0.5) * image_scale, (numpy.asarray(row) + 0.5) * image_scale)
+
+    def projToCV2Array(self, easting, northing, image_scale):
+        x, y = self.projToENUArray(easting, northing)
+        return self.enuToCV2Array(x, y, image_scale)
+
+    def cv2ToProjArray(self, row, column, image_scale):
+        return self.enuToProjArray(*self.cv2ToENUArray(row, column, image_scale))
+
+    # The offset moves the image origin, so points left of or below it are negative and are floored instead of truncated
+    # to stay on the same pixels as without the offset
+    def latlonToCV2Array(self, lat, lon, image_scale, offset_x=0.0, offset_y=0.0):
+        x, y = self.latlonToENUArray(lat, lon)
+        column = numpy.floor((x + offset_x) / image_scale).astype(int)
+        row = numpy.floor((y + offset_y) / image_scale).astype(int)
+        return (row, column)
+
+    def cv2ToLatLonArray(self, row, column, image_scale):
+        return self.enuToLatLonArray(*self.cv2ToENUArray(row, column, image_scale))
+
+    def enuToTGCArray(self, x, y, z):
+        x = numpy.asarray(x)
+        east_component = x - self.width / 2.0
+        north_component = numpy.asarray(y) - self.height / 2.0
+        # Match the shape of the other coordinates if z is a single value
+        return (east_component, numpy.broadcast_to(-numpy.asarray(z, numpy.float64), east_component.shape), north_component)
+
+    def projToTGCArray(self, easting, northing, z):
+        x, y = self.projToENUArray(easting, northing)
+        return self.enuToTGCArray(x, y, z)
+
+    def cv2ToTGCArray(self, row, column, image_scale):
+        x, y = self.cv2ToENUArray(row, column, image_scale)
+        return self.enuToTGCArray(x, y, 0.0)
+
+    def tgcToENUArray(self, x, y, z):
+        return (numpy.asarray(x) + self.width / 2.0, numpy.asarray(z) + self.height / 2.0, -numpy.asarray(y))
+
+    def tgcToCV2Array(self, x, z, image_scale):
+        enu = self.tgcToENUArray(x, 0.0, z)
+        return self.enuToCV2Array(enu[0], enu[1], image_scale)
+
+    def latlonToTGCArray(self, lat, lon, offset_x=0.0, offset_y=0.0):
+        x, y = self.latlonToENUArray(lat, lon)
+        return self.enuToTGCArray(x+offset_x, y+offset_y, 0.0)
+
+    @property
+    def capacity(self):
+        if self._columns is None:
+            return 0
+        return len(self._columns['x'])
+
+    # Reallocates each column to hold capacity points
+    # One column is copied at a time so memory never doubles for the whole pointcloud
+    def _resize(self, capacity):
+        if self._columns is None:
+            self._columns = {name: numpy.empty(capacity, dtype) for name, dtype in point_columns}
             return
-        self.point_matrix = numpy.vstack((self.point_matrix, newstack))
+        for name, dtype in point_columns:
+            new_column = numpy.empty(capacity, dtype)
+            new_column[:self._size] = self._columns[name][:self._size]
+            self._columns[name] = new_column
+
+    # Preallocate room for count points in total, for example from the lidar file headers
+    def reserve(self, count):
+        if count > self.capacity:
+            self._resize(count)
+
+    # Release any unused preallocated room
+    def trim(self):
+        if self.capacity > self._size:
+            self._resize(self._size)
+
+    def addDataSet(self, newX, newY, newZ, newI, newC):
+        new_count = len(numpy.ravel(newX))
+        needed = self._size + new_count
+        if needed > self.capacity:
+            # Grow geometrically so many small datasets don't copy the existing points every time
+            self._resize(max(needed, int(1.5*self.capacity)))
+        for (name, dtype), values in zip(point_columns, (newX, newY, newZ, newI, newC)):
+            self._columns[name][self._size:needed] = numpy.ravel(values)
+        if new_count > 0:
+            self._updateBounds(self._size, needed)
+        self._size = needed
+        self._clearRasterCaches()
 
     def addFromImage(self, image, image_scale, latlon_origin, proj):
-        # Insert points
-        X = []
-        Y = []
-        Z = []
-        I = []
-        C = []
-
-        for row in range(0, image.shape[0]):
-            for column in range(0, image.shape[1]):
-                z = image[row, column]
-                if math.isfinite(z):
-                    x, y = self.cv2ToENU(row, column, image_scale)
-                    X.append(x)
-                    Y.append(y)
-                    Z.append(z)
-                    I.append(0.0)
-                    C.append(0.0)
-
-        self.addDataSet(X, Y, Z, I, C)
+        # Heightmaps have an extra single channel dimension
+        elevations = numpy.asarray(image)
+        if elevations.ndim == 3:
+            elevations = elevations[:,:,0]
+
+        # Insert a point at the center of every finite pixel, in row by row order
+        rows, columns = numpy.nonzero(numpy.isfinite(elevations))
+        X, Y = self.cv2ToENUArray(rows, columns, image_scale)
+        zeros = numpy.zeros(len(rows), numpy.uint8)
+        self.reserve(self.count + len(rows))
+        self.addDataSet(X, Y, elevations[rows, columns], zeros, zeros)
 
         # Need to store the lowest coordinates in case we cropped the image by not inserting invalid pixels
         # These will become zero when removeBias() is called and helps center large or offset courses to fit
         # Within the 2k square
-        west_most_point = numpy.min(self.point_matrix[:,0]) # Offset from 0.0 left edge to west most point
-        south_most_point = numpy.min(self.point_matrix[:,1]) # Offset from 0.0 bottom edge to south most point
+        west_most_point = self.columnMin('x') # Offset from 0.0 left edge to west most point
+        south_most_point = self.columnMin('y') # Offset from 0.0 bottom edge to south most point
 
         # Calculate the origin of these points
         self._proj = proj
@@ -343,13 +621,18 @@ class GeoPointCloud:
     def computeOrigin(self):
         # Estimates the lower left corner as the origin
         # Manually compute origin from data in projected coordinates
-        mineasting = numpy.min(self.point_matrix[:,0])
-        minnorthing = numpy.min(self.point_matrix[:,1])
+        mineasting = self.columnMin('x')
+        minnorthing = self.columnMin('y')
         self._origin = (mineasting, minnorthing)
 
     def removeBias(self):
-        self.point_matrix[:,0] = self.point_matrix[:,0] - numpy.min(self.point_matrix[:,0])
-        self.point_matrix[:,1] = self.point_matrix[:,1] - numpy.min(self.point_matrix[:,1])
+        for name in ['x', 'y']:
+            column = self.column(name)
+            column_min, column_max = self._bounds[name]
+            column -= column_min
+            self._bounds[name] = (column_min - column_min, column_max - column_min)
+        self._clearRasterCaches()
         # No need to clip z to the ground since the tool can do that at the end
         # Helps keep all heights consistent for multiple resolution heightmaps and other features
-        #self.point_matrix[:,2] = self.point_matrix[:,2] - numpy.min(self.point_matrix[:,2])
+        #z = self.z
+        #z -= numpy.min(z)
@@ -415,13 +415,12 @@ def addOSMToTGC(course_json, geopointcloud, osm_result, x_offset=0.0, y_offset=0
             pass
 
         # Get the shape of this way
-        nds = []
         try:
-            for node in way.get_nodes(resolve_missing=True): # Allow automatically resolving missing nodes, but this is VERY slow with the API requests, try to request beforehand
-                nds.append(geopointcloud.latlonToTGC(node.lat, node.lon, x_offset, y_offset))
+            nodes = way.get_nodes(resolve_missing=True) # Allow automatically resolving missing nodes, but this is VERY slow with the API requests, try to request beforehand
         except overpy.exception.OverPyException:
             printf("OpenStreetMap servers are too busy right now.  Try running this tool later.")
             return []
+        nds = list(zip(*geopointcloud.latlonToTGCArray([node.lat for node in nodes], [node.lon for node in nodes], x_offset, y_offset)))
         # Check this shapes bounding box against the limits of the terrain, don't draw outside this bounds
         # Left, Top, Right, Bottom
         nbb = nodeBoundingBox(nds)
@@ -509,23 +508,22 @@ def addOSMToTGC(course_json, geopointcloud, osm_result, x_offset=0.0, y_offset=0
     trees = [] # Trees must be dealt with differently, and are passed up to a higher level.  Tree format is (x, z, radius, height)
     if options_dict.get('tree', False): # Trees are currently the only node right now.  This takes a lot of time to loop through, so skip if possible
         if not options_dict.get('lidar_trees', False):
-            num_nodes = len(osm_result.nodes)
+            tree_nodes = [node for node in osm_result.nodes if node.tags.get("natural", None) == "tree"]
+            tree_nds = list(zip(*geopointcloud.latlonToTGCArray([node.lat for node in tree_nodes], [node.lon for node in tree_nodes], x_offset, y_offset)))
+            num_nodes = len(tree_nds)
             last_print_time = time.time()
-            for n, node in enumerate(osm_result.nodes):
+            for n, nd in enumerate(tree_nds):
                 if time.time() > last_print_time + status_print_duration:
                     last_print_time = time.time()
                     printf(str(round(100.0*float(n) / num_nodes, 2)) + "% done looking for OpenStreetMap Trees")
 
-                natural_type = node.tags.get("natural", None)
-                if natural_type == "tree":
-                    nd = geopointcloud.latlonToTGC(node.lat, node.lon, x_offset, y_offset)
-                    # Check this shapes bounding box against the limits of the terrain, don't draw outside this bounds
-                    # Left, Top, Right, Bottom
-                    nbb = nodeBoundingBox([nd])
-                    if nbb[0] < ul_tgc[0] or nbb[1] > ul_tgc[2] or nbb[2] > lr_tgc[0] or nbb[3] < lr_tgc[2]:
-                        # Off of map, skip
-                        continue
-                    trees.append(newTree(nd))
+                # Check this shapes bounding box against the limits of the terrain, don't draw outside this bounds
+                # Left, Top, Right, Bottom
+                nbb = nodeBoundingBox([nd])
+                if nbb[0] < ul_tgc[0] or nbb[1] > ul_tgc[2] or nbb[2] > lr_tgc[0] or nbb[3] < lr_tgc[2]:
+                    # Off of map, skip
+                    continue
+                trees.append(newTree(nd))
         else:
             printf("Lidar trees requested: not adding trees from OpenStreetMap")
 
@@ -559,12 +557,10 @@ def addOSMFromXML(course_json, xml_data, options_dict={}, printf=print):
 
 def drawWayOnImage(way, color, im, pc, image_scale, thickness=-1, x_offset=0.0, y_offset=0.0):
     # Get the shape of this way and draw it as a poly
-    nds = []
-    for node in way.get_nodes(resolve_missing=True): # Allow automatically resolving missing nodes, but this is VERY slow with the API requests, try to request them above instead
-        nds.append(pc.latlonToCV2(node.lat, node.lon, image_scale, x_offset, y_offset))
+    nodes = way.get_nodes(resolve_missing=True) # Allow automatically resolving missing nodes, but this is VERY slow with the API requests, try to request them above instead
+    rows, columns = pc.latlonToCV2Array([node.lat for node in nodes], [node.lon for node in nodes], image_scale, x_offset, y_offset)
     # Uses points and not image pixels, so flip the x and y
-    nds = np.array(nds)
-    nds[:,[0, 1]] = nds[:,[1, 0]]
+    nds = np.column_stack((columns, rows))
     nds = np.int32([nds]) # Bug with fillPoly, needs explict cast to 32bit
     cv2.fillPoly(im, nds, color) 
 
@@ -601,6 +597,6 @@ def addOSMToImage(ways, im, pc, image_scale, x_offset=0.0, y_offset=0.0, printf=
         golf_type = way.tags.get("golf", None)
         if golf_type == "bunker":
             color = (0.85, 0.85, 0.7)
-            drawWayOnImage(way, color, im, pc, image_scale, x_offset, y_offset)
+            drawWayOnImage(way, color, im, pc, image_scale, x_offset=x_offset, y_offset=y_offset)
 
     return im
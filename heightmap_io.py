@@ -0,0 +1,108 @@
+import json
+import numpy as np
+import os
+import pyproj
+
+# Stores the heightmap made by lidar_map_api without pickle
+# The metadata is json, every image is a .npy file that can be memory mapped so only the images that are used are read
+# The projection is kept as its proj string so the files don't depend on the pyproj version
+metadata_name = 'heightmap.json'
+legacy_name = 'heightmap.npy' # Pickled dictionary written by older versions
+format_version = 1
+
+# Trees found in the lidar, in projected coordinates
+tree_dtype = [('easting', np.float64), ('northing', np.float64), ('radius', np.float32), ('height', np.float32)]
+
+def _image_path(directory, name):
+    return os.path.join(directory, 'heightmap.' + name + '.npy')
+
+def _save(path, array):
+    # Write next to the file first so an interrupted write doesn't leave half of an image
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+# levels is a list of dictionaries of 'heightmap', 'image_scale' and 'origin', level 0 is full resolution
+# visual is the RGB image of the heightmap pixels, trees is a list of (easting, northing, radius, height)
+def write_heightmap(directory, levels, visual, projection, trees):
+    os.makedirs(directory, exist_ok=True)
+    metadata = {'version': format_version, 'projection': projection.srs, 'levels': []}
+    for level, level_data in enumerate(levels):
+        name = 'level' + str(level)
+        _save(_image_path(directory, name), np.asarray(level_data['heightmap'], np.float32))
+        metadata['levels'].append({'image': name, 'image_scale': float(level_data['image_scale']), 'origin': [float(o) for o in level_data['origin']]})
+    _save(_image_path(directory, 'visual'), np.asarray(visual, np.float32))
+    _save(_image_path(directory, 'trees'), np.array([tuple(tree) for tree in trees], dtype=tree_dtype))
+
+    # The metadata is written last, it is what makes the images valid
+    tmp_path = os.path.join(directory, metadata_name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, metadata_name))
+
+# A heightmap opened with open_heightmap
+# Images are only read when asked for, and are read only memory maps when they come from .npy files
+class HeightmapFile:
+    def __init__(self, directory, metadata=None, legacy=None):
+        self.directory = directory
+        self._metadata = metadata
+        self._legacy = legacy
+        if legacy is not None:
+            # The pickled dictionary is one full resolution level
+            self.path = os.path.join(directory, legacy_name)
+            levels = [legacy]
+        else:
+            self.path = os.path.join(directory, metadata_name)
+            levels = metadata['levels']
+        self.levels = [{'image_scale': level['image_scale'], 'origin': tuple(level['origin'])} for level in levels]
+        self._projection = None
+
+    # Scale and origin of the full resolution level
+    @property
+    def image_scale(self):
+        return self.levels[0]['image_scale']
+
+    @property
+    def origin(self):
+        return self.levels[0]['origin']
+
+    @property
+    def projection(self):
+        if self._projection is None:
+            if self._legacy is not None:
+                self._projection = self._legacy['projection']
+            else:
+                self._projection = pyproj.Proj(self._metadata['projection'])
+        return self._projection
+
+    # Returns the (height, width, 1) elevations of a level, level 0 is full resolution
+    def heightmap(self, level=0):
+        if self._legacy is not None:
+            return self._legacy['heightmap']
+        return np.load(_image_path(self.directory, self._metadata['levels'][level]['image']), mmap_mode='r')
+
+    # Returns the (height, width, 3) visual image of the full resolution level
+    def visual(self):
+        if self._legacy is not None:
+            return self._legacy['visual']
+        return np.load(_image_path(self.directory, 'visual'), mmap_mode='r')
+
+    # Returns the trees as an array of tree_dtype
+    def trees(self):
+        if self._legacy is not None:
+            return np.array([tuple(tree) for tree in self._legacy.get('trees', [])], dtype=tree_dtype)
+        return np.load(_image_path(self.directory, 'trees'), mmap_mode='r')
+
+# Opens the heightmap in directory, falling back to the pickled heightmap.npy of older versions
+# Raises FileNotFoundError if there is neither
+def open_heightmap(directory):
+    try:
+        with open(os.path.join(directory, metadata_name), 'r') as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        legacy = np.load(os.path.join(directory, legacy_name), allow_pickle=True).item()
+        return HeightmapFile(directory, legacy=legacy)
+    if metadata.get('version') != format_version:
+        raise ValueError("Heightmap in " + directory + " is version " + str(metadata.get('version')) + ", expected " + str(format_version))
+    return HeightmapFile(directory, metadata=metadata)
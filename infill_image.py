@@ -1,8 +1,16 @@
+import collections
+import concurrent.futures
 import cv2
 import math
 import numpy as np
+import os
+import time
 
+import lidar_raster
+
+from scipy import ndimage
 from scipy.interpolate import griddata
+from scipy.spatial import Delaunay, QhullError
 
 def apply_mask(np_array, mask, invalid_value=math.nan):
     np_array[ mask < 1 ] = invalid_value
@@ -34,62 +42,321 @@ def get_binary_mask(cv2_mask):
 
     return remove_mask, preserve_mask
 
+# Linear interpolation of the values at points at the outs pixels, nan outside of the triangles of the points
+def _interpolate(points, values, outs):
+    if len(outs) == 0:
+        return np.zeros(0, np.float64)
+    if len(points) >= 3:
+        try:
+            return griddata(points, values, outs, method='linear', fill_value=math.nan)
+        except QhullError:
+            pass # All of the points are in a line
+    # Not enough points to make any triangles
+    return np.full(len(outs), math.nan, np.float64)
+
+# Like _interpolate, but the points are only the ones in the window of rows and columns of an image
+# A triangle of the window's points is also a triangle of every point of the image if its circumcircle has no point outside of the window in it,
+# pixels in other triangles are nan so they can be interpolated again from a larger window
+# Sides of the window at the edge of the image have no points past them
+def _interpolate_window(points, values, outs, window, image_shape):
+    interpolated = np.full(len(outs), math.nan, np.float64)
+    if len(outs) == 0 or len(points) < 3:
+        return interpolated
+    try:
+        triangulation = Delaunay(points)
+    except QhullError:
+        return interpolated # All of the points are in a line
+    simplices = triangulation.find_simplex(outs)
+    inside = simplices >= 0
+    simplices = simplices[inside]
+
+    # Circumcircles, relative to the first corner of each triangle
+    corners = triangulation.points[triangulation.simplices[simplices]]
+    b = corners[:,1] - corners[:,0]
+    c = corners[:,2] - corners[:,0]
+    d = 2.0*(b[:,0]*c[:,1] - b[:,1]*c[:,0])
+    b_squared = np.sum(b*b, axis=1)
+    c_squared = np.sum(c*c, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        center = corners[:,0] + np.column_stack(((c[:,1]*b_squared - b[:,1]*c_squared) / d, (b[:,0]*c_squared - c[:,0]*b_squared) / d))
+        radius = np.hypot(center[:,0] - corners[:,0,0], center[:,1] - corners[:,0,1])
+    trusted = np.isfinite(radius)
+    (lower_row, upper_row), (lower_column, upper_column) = window
+    if lower_row > 0:
+        trusted &= center[:,0] - radius > lower_row - 1
+    if upper_row < image_shape[0]:
+        trusted &= center[:,0] + radius < upper_row
+    if lower_column > 0:
+        trusted &= center[:,1] - radius > lower_column - 1
+    if upper_column < image_shape[1]:
+        trusted &= center[:,1] + radius < upper_column
+    if lower_row <= 0 and upper_row >= image_shape[0] and lower_column <= 0 and upper_column >= image_shape[1]:
+        trusted[:] = True # The window is the whole image
+
+    # Barycentric coordinates of each pixel in its triangle
+    transform = triangulation.transform[simplices]
+    barycentric = np.einsum('ijk,ik->ij', transform[:,:2], outs[inside] - transform[:,2])
+    barycentric = np.column_stack((barycentric, 1.0 - np.sum(barycentric, axis=1)))
+    found = np.sum(values[triangulation.simplices[simplices]] * barycentric, axis=1)
+    found[~trusted] = math.nan
+    interpolated[inside] = found
+    return interpolated
+
+# Returns a boolean array of which pixels are inside the convex hull of the true pixels of sources
+# Every corner of the hull is the first or last source of its row, so only those are triangulated
+def _inside_hull(sources, pixels):
+    inside = np.zeros(len(pixels), bool)
+    rows = np.flatnonzero(np.any(sources, axis=1))
+    if len(rows) == 0 or len(pixels) == 0:
+        return inside
+    row_sources = sources[rows]
+    first_columns = np.argmax(row_sources, axis=1)
+    last_columns = row_sources.shape[1] - 1 - np.argmax(row_sources[:,::-1], axis=1)
+    corners = np.unique(np.concatenate((np.column_stack((rows, first_columns)), np.column_stack((rows, last_columns)))), axis=0)
+    if len(corners) < 3:
+        return inside
+    try:
+        return Delaunay(corners).find_simplex(pixels) >= 0
+    except QhullError:
+        return inside # All of the sources are in a line
+
+# Returns a float64 image with the targets pixels linearly interpolated from the sources pixels of image, other pixels are nan
+# tile_pixels of None triangulates every source at once
+# Otherwise each tile_pixels x tile_pixels tile is interpolated on its own from the sources up to overlap + halo pixels around it,
+# which bounds the memory and lets the tiles run in a thread pool (Qhull releases the GIL)
+# Tiles are evaluated overlap pixels past their edges and blended with their neighbours there, so there are no seams
+# A tile only keeps the triangles that every source would make too, see _interpolate_window, so the result matches one triangulation
+# Targets that no tile could fill that way, like the middle of a large hole, are filled by each connected area of them
+# from the sources around the area, twice as far out each time, until they are filled or the sources are the whole image
+# The tiles are blended in order, so the result is identical for any number of workers
+def interpolate_pixels(image, sources, targets, tile_pixels=None, halo=64, overlap=16, workers=None, printf=print):
+    result = np.full(image.shape, math.nan, np.float64)
+    if tile_pixels is None:
+        result[targets] = _interpolate(np.argwhere(sources), image[sources], np.argwhere(targets))
+        return result
+
+    height, width = image.shape
+    tiles = [(row, column) for row in range(0, height, tile_pixels) for column in range(0, width, tile_pixels)]
+
+    # Blending weight along one side of a tile, ramps across the overlap unless that side is the edge of the image
+    def ramp(lower, upper, size):
+        positions = np.arange(lower, upper)
+        weights = np.ones(len(positions), np.float64)
+        if lower > 0:
+            weights = np.minimum(weights, (positions - lower + 1) / (2.0*overlap + 1))
+        if upper < size:
+            weights = np.minimum(weights, (upper - positions) / (2.0*overlap + 1))
+        return weights
+
+    # Interpolates the outs pixels from the sources in the rows and columns slices
+    def interpolate_window(rows, columns, outs):
+        window_sources = sources[rows, columns]
+        points = np.argwhere(window_sources) + (rows.start, columns.start)
+        values = image[rows, columns][window_sources]
+        return _interpolate_window(points, values, outs, ((rows.start, rows.stop), (columns.start, columns.stop)), image.shape)
+
+    def interpolate_tile(tile):
+        row, column = tile
+        # Pixels that are evaluated, past the tile so they can be blended
+        lower_row = max(0, row - overlap)
+        upper_row = min(height, row + tile_pixels + overlap)
+        lower_column = max(0, column - overlap)
+        upper_column = min(width, column + tile_pixels + overlap)
+        outs = np.argwhere(targets[lower_row:upper_row, lower_column:upper_column]) + (lower_row, lower_column)
+        # Points that are triangulated, further out so the triangles at the edges are like the ones of the whole image
+        interpolated = interpolate_window(slice(max(0, lower_row - halo), min(height, upper_row + halo)), \
+                                          slice(max(0, lower_column - halo), min(width, upper_column + halo)), outs)
+        weights = ramp(lower_row, upper_row, height)[outs[:,0] - lower_row] * ramp(lower_column, upper_column, width)[outs[:,1] - lower_column]
+        return outs, interpolated, weights
+
+    # Interpolates the pixels of one area that the tiles couldn't fill, widening the sources until they are all filled
+    def interpolate_area(area):
+        rows, columns = area
+        outs = np.argwhere(missing[rows, columns]) + (rows.start, columns.start)
+        interpolated = np.full(len(outs), math.nan, np.float64)
+        margin = halo
+        while True:
+            margin *= 2
+            window_rows = slice(max(0, rows.start - margin), min(height, rows.stop + margin))
+            window_columns = slice(max(0, columns.start - margin), min(width, columns.stop + margin))
+            unfilled = np.isnan(interpolated)
+            interpolated[unfilled] = interpolate_window(window_rows, window_columns, outs[unfilled])
+            if not np.any(np.isnan(interpolated)) or (window_rows == slice(0, height) and window_columns == slice(0, width)):
+                return outs, interpolated
+
+    sums = np.zeros(image.shape, np.float64)
+    weight_sums = np.zeros(image.shape, np.float64)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    last_print_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Only a few tiles are kept in flight so finished tiles can be blended and freed
+        pending = collections.deque()
+        next_tile = 0
+        finished = 0
+        while next_tile < len(tiles) or pending:
+            while next_tile < len(tiles) and len(pending) < 2*workers:
+                pending.append(executor.submit(interpolate_tile, tiles[next_tile]))
+                next_tile += 1
+            outs, interpolated, weights = pending.popleft().result()
+            found = np.isfinite(interpolated)
+            rows = outs[found,0]
+            columns = outs[found,1]
+            # Every pixel is in at most four tiles, so there are no repeated pixels within one tile
+            sums[rows, columns] += weights[found] * interpolated[found]
+            weight_sums[rows, columns] += weights[found]
+            finished += 1
+            if time.time() > last_print_time + 1.0:
+                last_print_time = time.time()
+                printf(str(round(100.0*float(finished) / len(tiles), 2)) + "% filling heightmap")
+
+        found = targets & (weight_sums > 0)
+        result[found] = sums[found] / weight_sums[found]
+        del sums, weight_sums
+
+        # Targets outside of the hull of every source are nan for one triangulation too, don't search for sources for them
+        missing = targets & ~found
+        missing_pixels = np.argwhere(missing)
+        missing[tuple(missing_pixels[~_inside_hull(sources, missing_pixels)].T)] = False
+        if np.any(missing):
+            areas = ndimage.find_objects(ndimage.label(missing, structure=np.ones((3, 3)))[0])
+            printf("Filling " + str(np.count_nonzero(missing)) + " heightmap pixels far from the lidar in " + str(len(areas)) + " areas")
+            for outs, interpolated in executor.map(interpolate_area, areas):
+                result[outs[:,0], outs[:,1]] = interpolated
+    return result
+
+# Returns a float64 copy of image with the holes pixels interpolated from the sources pixels near them
+# Only the sources within ring_width pixels of a hole are triangulated, so the time depends on the area of the holes instead of the image
+# The rings are dense, so the triangle around each hole pixel is made from the ring of its own hole, like triangulating each hole separately
+# Hole pixels outside of the rings' triangles stay nan
+# tile_pixels and workers are passed to interpolate_pixels
+def fill_holes(image, sources, holes, ring_width=1, tile_pixels=None, workers=None, printf=print):
+    filled = image.astype(np.float64)
+    if not np.any(holes):
+        return filled
+    ring = sources & ndimage.binary_dilation(holes, iterations=ring_width)
+    filled[holes] = interpolate_pixels(image, ring, holes, tile_pixels=tile_pixels, workers=workers, printf=printf)[holes]
+    return filled
+
+# Returns the mean position and mean value of the valid pixels in each ratio x ratio block that has any
+# Used to triangulate far fewer points when only a coarse result is needed, partial blocks at the edges are kept
+# The first and last valid pixel of every row and column are added as they are, so the points cover the same area as the valid pixels
+def block_points(image, valid, ratio):
+    if ratio == 1:
+        return np.argwhere(valid), image[valid]
+
+    height = -(-image.shape[0] // ratio)
+    width = -(-image.shape[1] // ratio)
+    padded = np.zeros((height*ratio, width*ratio), bool)
+    padded[:image.shape[0], :image.shape[1]] = valid
+    blocks = padded.reshape(height, ratio, width, ratio)
+    counts = blocks.sum(axis=(1, 3))
+    occupied = counts > 0
+    # Mean offset of the valid pixels from the lower left of their block
+    offsets = np.arange(ratio)
+    row_offsets = (blocks.sum(axis=3) * offsets[None,:,None]).sum(axis=1)[occupied] / counts[occupied]
+    column_offsets = (blocks.sum(axis=1) * offsets[None,None,:]).sum(axis=2)[occupied] / counts[occupied]
+    block_rows, block_columns = np.nonzero(occupied)
+    points = np.stack((block_rows*ratio + row_offsets, block_columns*ratio + column_offsets), axis=1)
+    values = lidar_raster.block_mean(image, valid, ratio)[occupied]
+
+    rows = np.flatnonzero(np.any(valid, axis=1))
+    first_columns = np.argmax(valid[rows], axis=1)
+    last_columns = image.shape[1] - 1 - np.argmax(valid[rows, ::-1], axis=1)
+    columns = np.flatnonzero(np.any(valid, axis=0))
+    first_rows = np.argmax(valid[:, columns], axis=0)
+    last_rows = image.shape[0] - 1 - np.argmax(valid[::-1, columns], axis=0)
+    edge_rows = np.concatenate((rows, rows, first_rows, last_rows))
+    edge_columns = np.concatenate((first_columns, last_columns, columns, columns))
+    points = np.concatenate((points, np.stack((edge_rows, edge_columns), axis=1)))
+    values = np.concatenate((values, image[edge_rows, edge_columns]))
+    return points, values
+
+# One red-black successive over-relaxation sweep per iteration of the Laplace equation over the pixels that aren't fixed
+# Pixels outside the image mirror their neighbour, so the edges don't pull the surface towards anything
+def _relax(image, fixed, iterations, omega=1.8):
+    parity = np.add.outer(np.arange(image.shape[0]), np.arange(image.shape[1])) % 2
+    colors = [~fixed & (parity == 0), ~fixed & (parity == 1)]
+    for iteration in range(iterations):
+        for color in colors:
+            padded = np.pad(image, 1, mode='edge')
+            neighbours = 0.25 * (padded[:-2,1:-1] + padded[2:,1:-1] + padded[1:-1,:-2] + padded[1:-1,2:])
+            image[color] += omega * (neighbours[color] - image[color])
+
+# Fills the pixels that aren't known with a smooth membrane (harmonic) surface that passes through the known pixels
+# The known pixels are averaged into a pyramid of images half the size each time, the smallest image is filled first
+# and each larger image starts from the one below it and is relaxed for a few iterations, so the time is linear in the number of pixels
+# Coarser images get 1.5 times the iterations of the one above them, they are a quarter of the size so that stays linear
+# Returns a float64 image, every pixel is filled unless nothing is known
+def fill_harmonic(image, known, iterations=10):
+    filled = np.where(known, image, math.nan).astype(np.float64)
+    if not np.any(known) or np.all(known):
+        return filled
+    # Some pixels are known and some aren't, so there are at least two pixels to average
+    coarse = lidar_raster.block_mean(filled, known, 2)
+    coarse = fill_harmonic(coarse, np.isfinite(coarse), math.ceil(1.5*iterations))
+    # Start from the coarse surface, each coarse pixel covers 2x2 pixels
+    start = np.repeat(np.repeat(coarse, 2, axis=0), 2, axis=1)[:image.shape[0], :image.shape[1]]
+    filled[~known] = start[~known]
+    _relax(filled, known, iterations)
+    return filled
+
 # Uses scipy griddata to interpolate and "recompute" the terrain data based on only the valid image points
 # Seems to produce a smoother and more natural result
 # Also allows us to sample in arbitrary sizes
-def infill_image_scipy(np_array, cv2_mask, background_ratio=16.0, fill_water=False, purge_water=False, printf=print):
-    remove_mask, preserve_mask = get_binary_mask(cv2_mask)
+# holes_only keeps the valid pixels and only interpolates the missing ones from a ring of valid pixels around them, see fill_holes
+# It is much faster when only a small part of the image is missing
+# tile_pixels interpolates the image in overlapping tiles on workers threads instead of all at once, see interpolate_pixels
+# method 'harmonic' fills the missing pixels with a smooth surface instead, see fill_harmonic
+# It takes linear time, keeps the valid pixels and also fills outside of the valid pixels, where griddata leaves nan
+def infill_image_scipy(np_array, cv2_mask, background_ratio=16.0, fill_water=False, purge_water=False, holes_only=False, tile_pixels=None, workers=None, \
+                       method='griddata', printf=print):
+    if method not in ['griddata', 'harmonic']:
+        raise ValueError("Unknown infill method: " + str(method))
 
-    # Get valid pixel elevations
-    full_points_list = []
-    full_values_list = []
-
-    points_list = []
-    values_list = []
-
-    output_list = []
+    remove_mask, preserve_mask = get_binary_mask(cv2_mask)
 
     printf("Finding valid masked points")
-    for row in np.arange(0, np_array.shape[0]):
-        for column in np.arange(0, np_array.shape[1]):
-            value = np_array[row, column][0]
-            masked = 1 # Pass through by default
-            if remove_mask is not None:
-                masked = remove_mask[row, column]
-
-            # Need to output a high resolution pixel for every pixel in original
-            output_list.append([row, column])
-
-            # Don't interpolate on invalid points
-            if not math.isnan(value):
-                # Background requires every valid point
-                full_points_list.append([row, column])
-                full_values_list.append(value)
-                if masked  > 0:
-                    # Only feed masked points into high resolution
-                    points_list.append([row, column])
-                    values_list.append(value)
-
-    points = np.array(points_list)
-    values = np.array(values_list)
-    outs = np.array(output_list)
+    # Don't interpolate on invalid points
+    valid = ~np.isnan(np_array[:,:,0])
+
+    # Only feed masked points into high resolution
+    if remove_mask is not None:
+        masked = valid & (remove_mask[:,:,0] > 0)
+    else:
+        masked = valid
 
     background_map = None
     if background_ratio is not None:
         printf("Generating low detail background")
-        starts = np.amin(output_list, axis=0)
-        ends = np.amax(output_list, axis=0)
+        starts = (0, 0)
+        ends = (np_array.shape[0] - 1, np_array.shape[1] - 1)
         background_row_count = math.ceil((ends[0]-starts[0])/background_ratio)
         background_col_count = math.ceil((ends[1]-starts[1])/background_ratio)
         background_outs = np.mgrid[starts[0]:ends[0]:background_ratio, starts[1]:ends[1]:background_ratio].reshape(2,-1).T
-        background_grid_z = griddata(full_points_list, full_values_list, background_outs, method='linear', fill_value=-1.0)
+        # Background requires every valid point, but it is much coarser than the heightmap
+        # Blocks of about half of a background pixel are averaged first so there are far fewer points to triangulate
+        points, values = block_points(np_array[:,:,0], valid, max(1, int(background_ratio / 2)))
+        background_grid_z = griddata(points, values, background_outs, method='linear', fill_value=-1.0)
         background_map = background_grid_z.reshape((background_row_count, background_col_count))
 
         if preserve_mask is not None:
             background_preserve_mask = cv2.resize(preserve_mask, (background_col_count, background_row_count), interpolation = cv2.INTER_AREA)
 
     printf("Filling missing data in heightmap")
-    detail_grid_z = griddata(points, values, outs, method='linear', fill_value=math.nan)
+    if method == 'harmonic':
+        # Pixels marked red are filled like the others so the surface continues under them, they are removed below
+        detail_grid_z = fill_harmonic(np_array[:,:,0], masked)
+    elif holes_only:
+        # Pixels marked red are removed below, so they don't need to be filled
+        holes = ~valid
+        if remove_mask is not None:
+            holes &= remove_mask[:,:,0] > 0
+        detail_grid_z = fill_holes(np_array[:,:,0], masked, holes, tile_pixels=tile_pixels, workers=workers, printf=printf)
+    else:
+        # Need to output a high resolution pixel for every pixel in original
+        every_pixel = np.ones(np_array.shape[:2], bool)
+        detail_grid_z = interpolate_pixels(np_array[:,:,0], masked, every_pixel, tile_pixels=tile_pixels, workers=workers, printf=printf)
 
     if remove_mask is not None:
         # Make sure that pixels marked red are not used
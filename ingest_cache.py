@@ -0,0 +1,73 @@
+import json
+import numpy as np
+import os
+
+from GeoPointCloud import point_columns
+
+# Keeps each lidar file's points after scaling and projection so later runs don't decode them again
+# Columns are stored as .npy files that can be memory mapped, the manifest remembers what they were made from
+manifest_name = 'manifest.json'
+manifest_version = 1
+
+def load_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, manifest_name), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == manifest_version:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'version': manifest_version, 'files': {}}
+
+def save_manifest(cache_dir, manifest):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = os.path.join(cache_dir, manifest_name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(cache_dir, manifest_name))
+    except OSError:
+        pass
+
+def projection_key(proj):
+    if proj is None:
+        return None
+    return proj.srs
+
+# Everything that changes the stored points for a file, except the projection they are converted to
+def file_fingerprint(path, force_epsg=None, force_unit=None, roi=None, roi_proj=None):
+    stat = os.stat(path)
+    fingerprint = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime, 'force_epsg': force_epsg, 'force_unit': force_unit, \
+                   'roi': roi, 'roi_proj': projection_key(roi_proj)}
+    # Match what comes back from json, tuples become lists
+    return json.loads(json.dumps(fingerprint))
+
+def _column_path(cache_dir, filename, name):
+    return os.path.join(cache_dir, filename + '.' + name + '.npy')
+
+# Returns the manifest entry for a file if its cached points are still valid, otherwise None
+def find_entry(manifest, filename, fingerprint):
+    entry = manifest['files'].get(filename)
+    if entry is None or entry['fingerprint'] != fingerprint:
+        return None
+    return entry
+
+# Returns the cached columns in point_columns order, memory mapped so nothing is read until used
+def read_columns(cache_dir, filename):
+    return [np.load(_column_path(cache_dir, filename, name), mmap_mode='r') for name, dtype in point_columns]
+
+# Stores the final columns of a file
+# target is the projection of the pointcloud the columns were converted to
+def write_columns(cache_dir, manifest, filename, fingerprint, columns, proj, default_proj, target):
+    # Forget the old entry first so a failed write can't be used later
+    manifest['files'].pop(filename, None)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for (name, dtype), values in zip(point_columns, columns):
+            np.save(_column_path(cache_dir, filename, name), np.asarray(values).astype(dtype))
+    except OSError:
+        return False
+
+    manifest['files'][filename] = {'fingerprint': fingerprint, 'count': len(columns[0]), 'proj': projection_key(proj), \
+                                   'default_proj': projection_key(default_proj), 'target': projection_key(target)}
+    return True
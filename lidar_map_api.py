@@ -10,23 +10,41 @@ import cv2
 from functools import partial
 import json
 import math
+import multiprocessing
 import numpy as np
 import os
+import queue
 import scipy
 import sys
+import threading
 import time
 import urllib
 
+import heightmap_io
+import lidar_raster
 import OSMTGC
 import tgc_tools
 import tree_mapper
 from usgs_lidar_parser import *
 
 # Parameters
-desired_visible_points_per_pixel = 1.0
 lidar_sample = 1 # Use every Nths lidar point.  1 is use all, 10 is use one of out 10
 lidar_to_disk = False
+ingest_workers = 1 # Processes used to read lidar files.  None uses every core, 1 reads the files one by one
+ingest_cache_name = None # Folder like 'tgc_ingest_cache' in the course output directory that keeps decoded lidar files between runs, None to disable.  It holds a copy of every point (GBs for large downloads), delete the folder to clear it
+epsg_cache_file = None # Optional json file, like tgc_epsg_cache.json in the temp directory, that remembers resolved EPSG codes between runs
 status_print_duration = 1.0 # Print progress every n seconds
+heightmap_statistic = 'percentile' # How the ground points in a pixel become its elevation: 'min', 'mean', 'percentile' or 'max'
+heightmap_percentile = 25.0 # Used by the percentile statistic, low values favor the ground over grass and noise
+visual_statistic = 'mean' # How the intensities in a pixel become the mask image value
+raster_chunk_size = 5000000 # Points rasterized at once, larger chunks are a little faster but use more memory
+raster_tile_size = 1024 # Pixels along each side of the image tiles that are rasterized in parallel
+raster_workers = None # Threads used to rasterize tiles, None uses every core
+preview_max_pixels = 2048 # Largest side of the course outline preview, it uses a coarser power of two multiple of the heightmap scale when needed
+stream_lidar = False # Rasterize the lidar files while they are read instead of loading every point first, memory then depends on the area instead of the number of points
+stream_queue_size = 4 # Chunks of points that can wait to be rasterized while streaming
+stream_statistic = 'min' # Used instead of a 'percentile' heightmap or visual statistic while streaming, percentiles keep every point until the end
+heightmap_levels = 3 # Heightmaps saved together at 1, 2, 4... times the heightmap scale, so coarser terrain can be tried without reading the lidar again
 
 # 1 Unassigned
 # 2 Ground
@@ -39,6 +57,7 @@ status_print_duration = 1.0 # Print progress every n seconds
 # 9 Water
 
 wanted_classifications = [2, 8] # These are considered "bare earth"
+counted_classifications = [2, 5, 6, 9] # Points of these classes are counted in every pixel, for finding ground, trees, buildings and water
 
 # Global Variables for the UI
 rect = None
@@ -229,44 +248,232 @@ def request_course_outline(course_image, sat_image=None, bundle=None, printf=pri
     popup.mainloop()
 
 
-def generate_lidar_previews(lidar_dir_path, sample_scale, output_dir_path, force_epsg=None, force_unit=None, printf=print):
+# Some pointclouds don't have intensity channel, so try to visualize elevation instead?
+def get_visualization(pc, printf=print):
+    if pc.imin == pc.imax:
+        printf("No lidar intensity found, using elevation instead")
+        return pc.z
+    return pc.intensity
+
+# Rasterizes the layers of the pointcloud at image_scale in one pass, see lidar_raster.RasterAccumulator
+# Tiles of the image are rasterized in parallel, the grid index finds the points of each tile
+# row_offset and column_offset rasterize only image_shape pixels starting from there, they must be multiples of the coarsest heightmap level's pixel size
+# layer_names optionally limits the layers that are made
+def rasterize_lidar(pc, image_scale, image_shape, row_offset=0, column_offset=0, layer_names=None, printf=print):
+    rows, columns = pc.rasterIndices(image_scale)
+    index = pc.gridIndex(image_scale)
+    visualization = get_visualization(pc, printf=printf)
+
+    def tile_points(lower_row, upper_row, lower_column, upper_column):
+        indices = index.queryRectangle(lower_row, upper_row, lower_column, upper_column)
+        if lidar_sample > 1:
+            # Keep every lidar_sample point counting from the first point of the pointcloud
+            indices = indices[indices % lidar_sample == 0]
+        for start in range(0, len(indices), raster_chunk_size):
+            chunk = indices[start:start+raster_chunk_size]
+            yield (rows[chunk], columns[chunk], pc.z[chunk], visualization[chunk], pc.classification[chunk])
+
+    return lidar_raster.rasterize_tiles(image_shape, tile_points, wanted_classifications, counted_classes=counted_classifications, \
+                                        tile_pixels=raster_tile_size, workers=raster_workers, row_offset=row_offset, column_offset=column_offset, printf=printf, \
+                                        ground_statistic=heightmap_statistic, ground_percentile=heightmap_percentile, visual_statistic=visual_statistic, \
+                                        layer_names=layer_names, ground_levels=heightmap_levels)
+
+# Rasterizes only the preview layer of the whole pointcloud at image_scale, in chunks of points on this thread
+# The preview is made once at a scale that is never used again, so it doesn't build the cached pixels and grid index of rasterize_lidar
+def rasterize_lidar_preview(pc, image_scale, image_shape, printf=print):
+    visualization = get_visualization(pc, printf=printf)
+    accumulator = lidar_raster.RasterAccumulator(image_shape, wanted_classifications, layer_names=['preview'])
+    for start in range(0, pc.count, raster_chunk_size):
+        # Keep every lidar_sample point counting from the first point of the pointcloud
+        chunk = slice(start + (-start) % lidar_sample, min(pc.count, start + raster_chunk_size), lidar_sample)
+        # Same truncation as GeoPointCloud.rasterIndices
+        rows = (pc.y[chunk]/image_scale).astype(np.int32)
+        columns = (pc.x[chunk]/image_scale).astype(np.int32)
+        accumulator.add(rows, columns, pc.z[chunk], visualization[chunk], pc.classification[chunk])
+    return accumulator.result()['preview']
+
+# Returns the power of two that the heightmap scale is multiplied by to keep the preview within preview_max_pixels
+def get_preview_ratio(image_width, image_height):
+    ratio = 1
+    while max(image_width, image_height) > ratio * preview_max_pixels:
+        ratio *= 2
+    return ratio
+
+# Reads the lidar files on another thread and rasterizes their points as they arrive, see stream_lidar
+# The pixels are aligned to multiples of image_scale in the projection, so the result doesn't depend on the order of the files
+# Returns a GeoPointCloud with the projection, origin and size of the layers but without points, and the layers
+# Returns None, None if nothing could be loaded
+def stream_lidar_layers(lidar_dir_path, image_scale, force_epsg=None, force_unit=None, roi=None, roi_proj=None, cache_dir=None, printf=print):
+    # Only this thread may print, printf may update the user interface
+    chunks = queue.Queue(maxsize=stream_queue_size)
+    stop = threading.Event()
+
+    # Waits for room in the queue, returns False without adding the item once rasterizing has stopped
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_chunks():
+        files = iterate_usgs_directory(lidar_dir_path, force_epsg=force_epsg, force_unit=force_unit, workers=ingest_workers, \
+                                       epsg_cache_file=epsg_cache_file, roi=roi, roi_proj=roi_proj, cache_dir=cache_dir, \
+                                       printf=lambda message: put(('message', message)))
+        try:
+            for result in files:
+                if result is None:
+                    put(('failed',))
+                    return
+                proj, columns = result
+                for start in range(0, len(columns[0]), raster_chunk_size):
+                    if not put(('points', proj, [column[start:start+raster_chunk_size] for column in columns])):
+                        return
+            put(('done',))
+        except Exception as e:
+            put(('error', e))
+        finally:
+            # Saves the caches and stops the worker processes even when rasterizing stopped early
+            files.close()
+
+    # Percentiles need every value of a pixel, which would make memory depend on the number of points again
+    ground_statistic = heightmap_statistic
+    if ground_statistic == 'percentile':
+        printf("Streaming lidar can't use the percentile heightmap statistic, using " + stream_statistic + " instead")
+        ground_statistic = stream_statistic
+    stream_visual_statistic = visual_statistic
+    if stream_visual_statistic == 'percentile':
+        printf("Streaming lidar can't use the percentile visual statistic, using " + stream_statistic + " instead")
+        stream_visual_statistic = stream_statistic
+
+    reader = threading.Thread(target=read_chunks, daemon=True)
+    reader.start()
+
+    # The coarser heightmap levels are made from the full resolution ground so there is only one statistic of the ground points
+    accumulator = lidar_raster.GrowingRasterAccumulator(wanted_classifications, counted_classes=counted_classifications, tile_pixels=raster_tile_size, \
+                                                        ground_statistic=ground_statistic, ground_percentile=heightmap_percentile, visual_statistic=stream_visual_statistic, \
+                                                        ground_levels=heightmap_levels, downsample_levels=True)
+    # Some pointclouds don't have intensity channel, so try to visualize elevation instead?
+    # Like a loaded pointcloud this is decided from every point, so the elevation layers are also made until the intensity is seen to change
+    elevation_accumulator = lidar_raster.GrowingRasterAccumulator(wanted_classifications, tile_pixels=raster_tile_size, visual_statistic=stream_visual_statistic, \
+                                                                  layer_names=['visual', 'preview'], ground_levels=heightmap_levels)
+    first_intensity = None
+    proj = None
+    num_points = 0
+    last_print_time = time.time()
+    try:
+        while True:
+            item = chunks.get()
+            if item[0] == 'message':
+                printf(item[1])
+                continue
+            if item[0] == 'done':
+                break
+            if item[0] == 'failed':
+                return None, None
+            if item[0] == 'error':
+                raise item[1]
+
+            proj = item[1]
+            x, y, z, intensity, classification = item[2]
+            if len(x) == 0:
+                continue
+
+            if elevation_accumulator is not None:
+                if first_intensity is None:
+                    first_intensity = np.amin(intensity)
+                if np.amin(intensity) != first_intensity or np.amax(intensity) != first_intensity:
+                    elevation_accumulator = None
+
+            # Keep every lidar_sample point counting from the first point
+            sample = slice((-num_points) % lidar_sample, None, lidar_sample)
+            num_points += len(x)
+            rows = np.floor(y[sample] / image_scale).astype(np.int64)
+            columns = np.floor(x[sample] / image_scale).astype(np.int64)
+            accumulator.add(rows, columns, z[sample], intensity[sample], classification[sample])
+            if elevation_accumulator is not None:
+                elevation_accumulator.add(rows, columns, z[sample], z[sample], classification[sample])
+
+            if time.time() > last_print_time + status_print_duration:
+                last_print_time = time.time()
+                printf(str(num_points) + " points rasterized")
+    finally:
+        # The reader can't be left waiting on a full queue, it holds the open files and their caches
+        stop.set()
+        while True:
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                break
+        reader.join()
+
+    layers, lower_row, lower_column = accumulator.result()
+    if layers is None:
+        printf("No valid lidar files found, no action taken")
+        printf("Directory was: " + lidar_dir_path)
+        return None, None
+    if elevation_accumulator is not None:
+        printf("No lidar intensity found, using elevation instead")
+        elevation_layers = elevation_accumulator.result()[0]
+        layers['visual'] = elevation_layers['visual']
+        layers['preview'] = elevation_layers['preview']
+
+    # Lower left of the lower left pixel is the origin, like the lowest point is for a loaded pointcloud
+    pc = GeoPointCloud()
+    pc.proj = proj
+    pc.origin = (lower_column * image_scale, lower_row * image_scale)
+    image_height, image_width = layers['count'].shape
+    pc.xmin = 0.0
+    pc.xmax = (image_width - 1) * image_scale
+    pc.width = pc.xmax
+    pc.ymin = 0.0
+    pc.ymax = (image_height - 1) * image_scale
+    pc.height = pc.ymax
+    pc.zmin = np.nanmin(layers['surface'])
+    pc.zmax = np.nanmax(layers['surface'])
+    return pc, layers
+
+# roi optionally limits the lidar to a region of interest, see usgs_lidar_parser.read_usgs_file
+def generate_lidar_previews(lidar_dir_path, sample_scale, output_dir_path, force_epsg=None, force_unit=None, roi=None, roi_proj=None, printf=print):
     # Create directory for intermediate files
     tgc_tools.create_directory(output_dir_path)
 
     # Use provided las or get las files
-    pc = load_usgs_directory(lidar_dir_path, force_epsg=force_epsg, force_unit=force_unit, printf=printf)
+    cache_dir = None
+    if ingest_cache_name is not None:
+        cache_dir = os.path.join(output_dir_path, ingest_cache_name)
+        printf("Keeping decoded lidar files in " + cache_dir + ", delete this folder to clear them")
+    if stream_lidar:
+        pc, layers = stream_lidar_layers(lidar_dir_path, sample_scale, force_epsg=force_epsg, force_unit=force_unit, roi=roi, roi_proj=roi_proj, \
+                                         cache_dir=cache_dir, printf=printf)
+    else:
+        pc = load_usgs_directory(lidar_dir_path, force_epsg=force_epsg, force_unit=force_unit, workers=ingest_workers, epsg_cache_file=epsg_cache_file, \
+                                 roi=roi, roi_proj=roi_proj, cache_dir=cache_dir, printf=printf)
 
     if pc is None:
         # Can't do anything with nothing
         return
 
-    image_width = math.ceil(pc.width/sample_scale)+1 # If image is exact multiple, then need one more pixel.  Example: 1500m -> 750 pixels, @1500, 750 isn't a valid pixel otherwise
-    image_height = math.ceil(pc.height/sample_scale)+1
-
-    printf("Generating lidar intensity image")
-    im = np.full((image_height,image_width,1), math.nan, np.float32)
-
-    img_points = pc.pointsAsCV2(sample_scale)
-    num_points = len(img_points)
-
-    point_density = float(num_points) / (image_width * image_height)
-
-    visible_sampling = math.floor(point_density/desired_visible_points_per_pixel) # Roughly get 1 sample per pixel for the visible image
-    if visible_sampling < 1.0:
-        visible_sampling = 1
-
-    # Some pointclouds don't have intensity channel, so try to visualize elevation instead?
-    visualization_axis = 3
-    if pc.imin == pc.imax:
-        printf("No lidar intensity found, using elevation instead")
-        visualization_axis = 2
-
-    last_print_time = time.time()
-    for n, i in enumerate(img_points[0::visible_sampling]):
-        if time.time() > last_print_time + status_print_duration:
-            last_print_time = time.time()
-            printf(str(round(100.0*float(n*visible_sampling) / num_points, 2)) + "% visualizing lidar")
-        im[int(i[0]), int(i[1])] = i[visualization_axis]
+    # The preview is only shown as a thumbnail, so it doesn't need every pixel of the heightmap
+    # The full resolution layers are made for the selected area in generate_lidar_heightmap
+    if stream_lidar:
+        # Streamed points are gone, so reduce the full resolution layers that were made while reading
+        preview_ratio = get_preview_ratio(layers['count'].shape[1], layers['count'].shape[0])
+        preview_scale = sample_scale * preview_ratio
+        printf("Generating lidar intensity image")
+        preview = lidar_raster.block_mean(layers['preview'], layers['count'], preview_ratio)
+    else:
+        preview_ratio = get_preview_ratio(math.ceil(pc.width/sample_scale)+1, math.ceil(pc.height/sample_scale)+1)
+        preview_scale = sample_scale * preview_ratio
+        image_width = math.ceil(pc.width/preview_scale)+1 # If image is exact multiple, then need one more pixel.  Example: 1500m -> 750 pixels, @1500, 750 isn't a valid pixel otherwise
+        image_height = math.ceil(pc.height/preview_scale)+1
+        printf("Generating lidar intensity image")
+        preview = rasterize_lidar_preview(pc, preview_scale, (image_height, image_width), printf=printf)
+        layers = None
+    printf("Preview is " + str(preview_scale) + " meters per pixel")
+    im = np.expand_dims(preview, axis=2) # Workaround until the extra image dimension is removed
 
     # Download OpenStreetMaps Data
     printf("Adding golf features to lidar data")
@@ -283,7 +490,7 @@ def generate_lidar_previews(lidar_dir_path, sample_scale, output_dir_path, force
     # Order is South, West, North, East
     result = OSMTGC.getOSMData(lower_right_latlon[0], upper_left_latlon[1], upper_left_latlon[0], lower_right_latlon[1], printf=printf)
     if result:
-        im = OSMTGC.addOSMToImage(result.ways, im, pc, sample_scale, printf=printf)
+        im = OSMTGC.addOSMToImage(result.ways, im, pc, preview_scale, printf=printf)
     else:
         printf("OpenStreetMap download failed.  You won't see helpful OSM outlines or drawings on your preview or mask.")
 
@@ -311,19 +518,28 @@ def generate_lidar_previews(lidar_dir_path, sample_scale, output_dir_path, force
     cv2.putText(sat_image, "GPS Center Coordinates: ", (10, 250), font, fontScale, fontColor, lineType)
     cv2.putText(sat_image, str(gps_center), (10, 350), font, fontScale, fontColor, lineType)
 
-    request_course_outline(im, sat_image, bundle=(pc, img_points, sample_scale, output_dir_path, result), printf=printf)
+    request_course_outline(im, sat_image, bundle=(pc, layers, sample_scale, preview_ratio, output_dir_path, result), printf=printf)
 
-def generate_lidar_heightmap(pc, img_points, sample_scale, output_dir_path, osm_results=None, printf=print):
+# The selection is in pixels of the preview, which are preview_ratio heightmap pixels wide
+# layers are the full resolution pixels of the whole pointcloud when streaming, otherwise None and only the selection is rasterized from pc
+def generate_lidar_heightmap(pc, layers, sample_scale, preview_ratio, output_dir_path, osm_results=None, printf=print):
     global lower_x
     global lower_y
     global upper_x
     global upper_y
-    image_width = math.ceil(pc.width/sample_scale)+1 # If image is exact multiple, then need one more pixel.  Example: 1500m -> 750 pixels, @1500, 750 isn't a valid pixel otherwise
-    image_height = math.ceil(pc.height/sample_scale)+1
+    if layers is not None:
+        image_height, image_width = layers['count'].shape
+    else:
+        image_width = math.ceil(pc.width/sample_scale)+1 # If image is exact multiple, then need one more pixel.  Example: 1500m -> 750 pixels, @1500, 750 isn't a valid pixel otherwise
+        image_height = math.ceil(pc.height/sample_scale)+1
 
     printf("Generating heightmap")
-    om = np.full((image_height,image_width,1), math.nan, np.float32)
-    high_res_visual = np.full((image_height,image_width,1), math.nan, np.float32)
+
+    # Convert the selection to heightmap pixels
+    lower_x *= preview_ratio
+    lower_y *= preview_ratio
+    upper_x *= preview_ratio
+    upper_y *= preview_ratio
 
     # Make sure selected limits are in bounds, otherwise limit them
     # This can happen if the rectangle goes outside the image
@@ -332,96 +548,59 @@ def generate_lidar_heightmap(pc, img_points, sample_scale, output_dir_path, osm_
     upper_x = min(image_width, upper_x)
     upper_y = min(image_height, upper_y)
 
+    # Must be around 1 meter grid size and a power of 2 from sample_scale, but never smaller than the heightmap pixels
+    tree_ratio = max(1, 2**(math.ceil(math.log2(1.0/sample_scale))))
+    tree_scale = sample_scale * tree_ratio
+
+    # Every heightmap level and the tree map need whole pixels, so grow the selection to line up with the largest of them
+    # Only the lower left needs to line up for the tree map, its partial pixels at the upper edges are dropped
+    level_pixels = 2**(heightmap_levels - 1)
+    alignment = max(tree_ratio, level_pixels)
+    lower_x = lower_x // alignment * alignment
+    lower_y = lower_y // alignment * alignment
+    upper_x = min(image_width, -(-upper_x // level_pixels) * level_pixels)
+    upper_y = min(image_height, -(-upper_y // level_pixels) * level_pixels)
+
     ## Start cropping data and saving it for future steps
     # Save only the relevant points from the raw pointcloud
     printf("Selecting only needed data from lidar")
     llenu = pc.cv2ToENU(upper_y, lower_x, sample_scale)
     urenu = pc.cv2ToENU(lower_y, upper_x, sample_scale)
 
-    # Remove the points not in the selection
-    # Use numpy to efficiently reduce the number of points we loop over to create the terrain image
-    selected_points = img_points[np.where(lower_y <= img_points[:,0])]
-    selected_points = selected_points[np.where(selected_points[:,0] < upper_y)]
-    selected_points = selected_points[np.where(lower_x <= selected_points[:,1])]
-    selected_points = selected_points[np.where(selected_points[:,1] < upper_x)]
-
-    # Remove points that aren't useful for ground heightmaps
-    ground_points = numpy.copy(selected_points) # Copy to preserve selected points for other uses like tree detection
-    ground_points = ground_points[np.isin(ground_points[:,4], wanted_classifications)]
+    # Only the selection is needed
+    if layers is None:
+        layers = rasterize_lidar(pc, sample_scale, (upper_y - lower_y, upper_x - lower_x), row_offset=lower_y, column_offset=lower_x, printf=printf)
+    else:
+        layers = lidar_raster.crop_layers(layers, lower_y, upper_y, lower_x, upper_x)
 
-    if len(ground_points) == 0:
+    # The layers only have ground elevations where there are ground points
+    if not np.any(np.isfinite(layers['ground'])):
         printf("\n\n\nSorry, this lidar data is not classified and I can't support it right now.  Ask for help on the forum or your lidar provider if they have a classified version.")
         printf("Classification is where they determine which points are the ground and which are trees, buildings, etc.  I can't make a nice looking course without clean input.")
         return
 
-    # Some pointclouds don't have intensity channel, so try to visualize elevation instead?
-    visualization_axis = 3
-    if pc.imin == pc.imax:
-        printf("No lidar intensity found, using elevation instead")
-        visualization_axis = 2
-
-    # Generate heightmap only for the selected area
-    num_points = len(ground_points)
-    last_print_time = time.time()
-    for n, i in enumerate(ground_points[0::lidar_sample]):
-        if time.time() > last_print_time + status_print_duration:
-            last_print_time = time.time()
-            printf(str(round(100.0*float(n*lidar_sample) / num_points, 2)) + "% generating heightmap")
-
-        c = (int(i[0]), int(i[1]))
-
-        # Add visual data
-        value = high_res_visual[c]
-        if math.isnan(value):
-            value = i[visualization_axis]
-        else:
-            value = (i[visualization_axis] - value) * 0.3 + value
-        high_res_visual[c] = value
-
-        # Add elevation data
-        elevation = om[c]
-        if math.isnan(elevation):
-            elevation = i[2]
-        else:
-            alpha = 0.1
-            if i[2] < elevation:
-                # Trend lower faster
-                alpha = 0.4
-            elevation = (i[2] - elevation) * alpha + elevation
-        om[c] = elevation
+    om = np.expand_dims(layers['ground'], axis=2) # Workaround until the extra image dimension is removed
+    high_res_visual = np.expand_dims(layers['visual'], axis=2)
 
     printf("Finished generating heightmap")
 
     printf("Starting tree detection")
     trees = []
     # Make a maximum heightmap
-    # Must be around 1 meter grid size and a power of 2 from sample_scale
-    tree_ratio = 2**(math.ceil(math.log2(1.0/sample_scale)))
-    tree_scale = sample_scale * tree_ratio
     printf("Tree ratio is: " + str(tree_ratio))
-    treemap = np.full((int(image_height/tree_ratio),int(image_width/tree_ratio),1), math.nan, np.float32)
-    num_points = len(selected_points)
-    last_print_time = time.time()
-    for n, i in enumerate(selected_points[0::lidar_sample]):
-        if time.time() > last_print_time + status_print_duration:
-            last_print_time = time.time()
-            printf(str(round(100.0*float(n*lidar_sample) / num_points, 2)) + "% generating object map")
-
-        c = (int(i[0]/tree_ratio), int(i[1]/tree_ratio))
-
-        # Add elevation data
-        if math.isnan(treemap[c]) or i[2] > treemap[c]:
-            # Just take the maximum value possible for this pixel
-            treemap[c] = i[2]
+    # Just take the maximum value possible for each pixel
+    # The highest point of a tree pixel is the highest of the surface pixels inside of it
+    treemap = lidar_raster.block_max(layers['surface'], tree_ratio)
+    treemap = np.expand_dims(treemap, axis=2)
     # Make a resized copy of the ground height that matches the object detection image size
-    groundmap = np.copy(om[lower_y:upper_y, lower_x:upper_x])
+    groundmap = np.copy(om)
     groundmap = numpy.array(Image.fromarray(groundmap[:,:,0], mode='F').resize((int(groundmap.shape[1]/tree_ratio), int(groundmap.shape[0]/tree_ratio)), resample=Image.NEAREST))
     groundmap = np.expand_dims(groundmap, axis=2) # Workaround until the extra image dimension is removed
-    img_trees = tree_mapper.getTreeCoordinates(groundmap, treemap[int(lower_y/tree_ratio):int(upper_y/tree_ratio), int(lower_x/tree_ratio):int(upper_x/tree_ratio)], printf=printf)
+    img_trees = tree_mapper.getTreeCoordinates(groundmap, treemap, printf=printf)
     trees = []
     for t in img_trees:
         # Convert to projection for better portability
-        proj = pc.cv2ToProj(int(lower_y/tree_ratio)+t[1], int(lower_x/tree_ratio)+t[0], tree_scale)
+        proj = pc.cv2ToProj(lower_y//tree_ratio + t[1], lower_x//tree_ratio + t[0], tree_scale)
         trees.append((proj[0], proj[1], t[2], t[3]))
 
     printf("Writing files to disk")
@@ -448,32 +627,34 @@ def generate_lidar_heightmap(pc, img_points, sample_scale, output_dir_path, osm_
     imc = normalize_image(imc)
     imc = cv2.cvtColor(imc, cv2.COLOR_GRAY2RGB)
     if osm_results:
-        imc = OSMTGC.addOSMToImage(osm_results.ways, imc, pc, sample_scale)
-    imc = imc[lower_y:upper_y, lower_x:upper_x]
+        # The image starts at the selection instead of the lower left of the pointcloud
+        imc = OSMTGC.addOSMToImage(osm_results.ways, imc, pc, sample_scale, x_offset=-lower_x*sample_scale, y_offset=-lower_y*sample_scale)
     # Need to flip to write to disk in standard image order
     imc = np.flip(imc, 0)
     printf("Saving mask as: " + str(output_dir_path) + '/mask.png')
     cv2.imwrite(output_dir_path + '/mask.png', cv2.cvtColor(255.0*imc, cv2.COLOR_RGB2BGR)) # not sure why it needs to be 255 scaled, but also needs a differnt colorspace
 
     # Prepare nice looking copy of intensity image to save
-    high_res_visual = high_res_visual[lower_y:upper_y, lower_x:upper_x]
+    high_res_visual = np.copy(high_res_visual) # Copy so the layers aren't changed
     high_res_visual = normalize_image(high_res_visual)
     high_res_visual = cv2.cvtColor(high_res_visual, cv2.COLOR_GRAY2RGB)
 
-    omc = om[lower_y:upper_y, lower_x:upper_x]
-    output_data = {'heightmap': omc}
-    output_data['visual'] = high_res_visual
-    output_data['pointcloud'] = output_points
-    output_data['image_scale'] = sample_scale
-    output_data['origin'] = pc.cv2ToLatLon(lower_y, lower_x, sample_scale) # Origin is lower left corner
-    output_data['projection'] = pc.proj
-    output_data['trees'] = trees
-    printf("Saving data as: " + str(output_dir_path) + '/heightmap.npy')
-    np.save(output_dir_path + '/heightmap', output_data) # Save as numpy format since we have raw float elevations
+    # Level 0 is the heightmap above, each level after it has pixels twice as large as the one before, starting from the same lower left corner
+    origin = pc.cv2ToLatLon(lower_y, lower_x, sample_scale) # Origin is lower left corner
+    levels = [{'heightmap': om, 'image_scale': sample_scale, 'origin': origin}]
+    for level, ground in enumerate(layers['ground_levels'], 1):
+        level_scale = sample_scale * 2**level
+        levels.append({'heightmap': np.expand_dims(ground, axis=2), 'image_scale': level_scale, \
+                       'origin': pc.cv2ToLatLon(lower_y >> level, lower_x >> level, level_scale)})
+    printf("Saving data as: " + str(output_dir_path) + '/' + heightmap_io.metadata_name)
+    heightmap_io.write_heightmap(output_dir_path, levels, high_res_visual, pc.proj, trees)
 
     printf("Done!  Now go edit your mask.png to remove uneeded areas")
 
 if __name__ == "__main__":
+    # Needed for the lidar reading process pool in frozen executables
+    multiprocessing.freeze_support()
+
     if len(sys.argv) < 4:
         print("Usage: python program.py LAS_DIRECTORY OUTPUT_DIRECTORY METERS_PER_PIXEL [FORCE_EPSG] [FORCE_UNIT]")
         sys.exit(0)
@@ -491,4 +672,5 @@ if __name__ == "__main__":
             force_unit = None
 
     running_as_main = True
+    ingest_workers = None # Use every core when run from the command line
     generate_lidar_previews(lidar_dir_path, meters_per_pixel, output_dir, force_epsg=force_epsg, force_unit=force_unit)
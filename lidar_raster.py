@@ -0,0 +1,445 @@
+import concurrent.futures
+import math
+import numpy as np
+import os
+import time
+
+# Statistics that can reduce the values of one pixel to one value
+statistics = ['min', 'mean', 'percentile', 'max']
+
+# Layers made by RasterAccumulator
+all_layer_names = ['ground', 'visual', 'surface', 'preview', 'count', 'class_counts']
+
+# Adds weights (or ones) to the flat image at pixels
+# Only the span of pixels that were hit is counted, so small chunks don't pay for the whole image
+def _add_at(flat_image, pixels, weights=None):
+    lowest = np.amin(pixels)
+    counts = np.bincount(pixels - lowest, weights=weights)
+    flat_image[lowest:lowest+len(counts)] += counts.astype(flat_image.dtype)
+
+# Reduces all of the values that land in the same pixel to one value
+# Values can be added in any number of chunks, call result() once they are all added
+# percentile is only used by the percentile statistic, 0.0 is the minimum and 100.0 the maximum
+# The result never depends on the order or chunking of the values, so the same points always make the same image
+class BinnedStatistic:
+    def __init__(self, shape, statistic='mean', percentile=50.0):
+        if statistic not in statistics:
+            raise ValueError("Unknown statistic: " + str(statistic) + ", use one of " + str(statistics))
+        self.shape = shape
+        self.statistic = statistic
+        self.percentile = percentile
+
+        size = shape[0] * shape[1]
+        if statistic == 'min':
+            self._image = np.full(size, math.inf, np.float32)
+        elif statistic == 'max':
+            self._image = np.full(size, -math.inf, np.float32)
+        elif statistic == 'mean':
+            # float32 values add up exactly in float64 unless they are tiny, so the sums don't depend on order either
+            self._sums = np.zeros(size, np.float64)
+            self._counts = np.zeros(size, np.uint32)
+        else:
+            # Percentiles need every value, keep them as compact sort keys until the result is needed
+            self._keys = []
+
+    # rows and columns are the pixel of each value, like GeoPointCloud.rasterIndices
+    # Values outside of shape are ignored
+    def add(self, rows, columns, values):
+        rows = np.asarray(rows)
+        columns = np.asarray(columns)
+        values = np.asarray(values)
+        inside = (0 <= rows) & (rows < self.shape[0]) & (0 <= columns) & (columns < self.shape[1])
+        if not np.all(inside):
+            rows = rows[inside]
+            columns = columns[inside]
+            values = values[inside]
+        if len(values) == 0:
+            return
+
+        # Flat pixel number of each value
+        pixels = rows.astype(np.int64) * self.shape[1] + columns
+        values = values.astype(np.float32)
+
+        if self.statistic == 'min':
+            np.minimum.at(self._image, pixels, values)
+        elif self.statistic == 'max':
+            np.maximum.at(self._image, pixels, values)
+        elif self.statistic == 'mean':
+            _add_at(self._sums, pixels, values)
+            _add_at(self._counts, pixels)
+        else:
+            # Sorting one 64 bit key is much faster than sorting by pixel and then value: the pixel is the high half
+            # and the float32 bits, flipped so they sort in numeric order, are the low half
+            bits = values.view(np.uint32)
+            bits = bits ^ np.where(bits >> 31, np.uint32(0xFFFFFFFF), np.uint32(0x80000000))
+            self._keys.append((pixels.astype(np.uint64) << np.uint64(32)) | bits)
+
+    # Returns a float32 image of shape with nan where there are no values
+    def result(self):
+        if self.statistic == 'min':
+            image = np.where(self._image == math.inf, np.float32(math.nan), self._image)
+        elif self.statistic == 'max':
+            image = np.where(self._image == -math.inf, np.float32(math.nan), self._image)
+        elif self.statistic == 'mean':
+            image = np.full(len(self._sums), math.nan, np.float32)
+            occupied = self._counts > 0
+            image[occupied] = self._sums[occupied] / self._counts[occupied]
+        else:
+            image = self._percentileResult()
+        return image.reshape(self.shape)
+
+    def _percentileResult(self):
+        image = np.full(self.shape[0] * self.shape[1], math.nan, np.float32)
+        if len(self._keys) == 0:
+            return image
+        keys = np.concatenate(self._keys)
+        self._keys = [keys] # Don't concatenate again if called twice
+        keys = np.sort(keys)
+        pixels = (keys >> np.uint64(32)).astype(np.int64)
+        bits = (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+        del keys
+        bits = bits ^ np.where(bits >> 31, np.uint32(0x80000000), np.uint32(0xFFFFFFFF))
+        values = bits.view(np.float32).astype(np.float64)
+
+        # Each pixel is one run of the sorted values
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(pixels)) + 1))
+        counts = np.diff(np.append(starts, len(pixels)))
+
+        # Linear interpolation between the two closest values, the same as np.percentile
+        position = (self.percentile / 100.0) * (counts - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, counts - 1)
+        fraction = position - lower
+        lower_values = values[starts + lower]
+        upper_values = values[starts + upper]
+        image[pixels[starts]] = lower_values + (upper_values - lower_values) * fraction
+        return image
+
+# Reduces all of the values that land in the same pixel to one value in a single call
+# Returns a float32 image of shape with nan where there are no values
+def bin_statistic(rows, columns, values, shape, statistic='mean', percentile=50.0):
+    binned = BinnedStatistic(shape, statistic=statistic, percentile=percentile)
+    binned.add(rows, columns, values)
+    return binned.result()
+
+# Builds every raster layer the lidar tools need in one pass over the points
+# Points are added in chunks, each chunk is only read once for all of the layers
+# Layers from result():
+#   ground: ground_statistic of the elevation of ground_classes points
+#   visual: visual_statistic of the visual value (intensity or elevation) of ground_classes points
+#   surface: highest elevation of any point, used to find trees and buildings
+#   preview: mean visual value of all points, for choosing the course outline
+#   count: number of points
+#   class_counts: dictionary of the number of points of each of counted_classes
+#   ground_levels: list of the ground layer at 2, 4, 8... times the pixel size, for ground_levels - 1 coarser levels
+# layer_names limits the layers that are made, count is always made
+# row_offset and column_offset place this raster inside a larger image, for rasterizing only part of the pixels
+# The coarser ground levels are computed from the points, not from the finer pixels, so every level is the true ground_statistic at its scale
+# With downsample_levels they are made from the ground layer instead, see downsample_level, so a percentile ground keeps one set of values instead of one per level
+# Pixel row, column of a level is row >> level, column >> level, so they only line up with other rasters if both start at a multiple of 2**level
+class RasterAccumulator:
+    def __init__(self, shape, ground_classes, counted_classes=[], ground_statistic='mean', ground_percentile=50.0, visual_statistic='mean', \
+                 layer_names=None, row_offset=0, column_offset=0, ground_levels=1, downsample_levels=False):
+        self.shape = shape
+        self.ground_classes = ground_classes
+        self.row_offset = row_offset
+        self.column_offset = column_offset
+        if layer_names is None:
+            layer_names = all_layer_names
+        self.layer_names = layer_names
+
+        self._statistics = {}
+        if 'ground' in layer_names:
+            self._statistics['ground'] = BinnedStatistic(shape, statistic=ground_statistic, percentile=ground_percentile)
+            self.ground_statistic = ground_statistic
+            self.ground_levels = ground_levels
+            self.downsample_levels = downsample_levels
+            if downsample_levels:
+                self._ground_levels = []
+                self._ground_count = np.zeros(shape[0] * shape[1], np.uint32)
+            else:
+                self._ground_levels = [BinnedStatistic(level_shape(shape, level), statistic=ground_statistic, percentile=ground_percentile) \
+                                       for level in range(1, ground_levels)]
+        if 'visual' in layer_names:
+            self._statistics['visual'] = BinnedStatistic(shape, statistic=visual_statistic)
+        if 'surface' in layer_names:
+            self._statistics['surface'] = BinnedStatistic(shape, statistic='max')
+        if 'preview' in layer_names:
+            self._statistics['preview'] = BinnedStatistic(shape, statistic='mean')
+        self._count = np.zeros(shape[0] * shape[1], np.uint32)
+        if 'class_counts' not in layer_names:
+            counted_classes = []
+        self.counted_classes = counted_classes
+        self._class_counts = {c: np.zeros(shape[0] * shape[1], np.uint32) for c in counted_classes}
+
+    # rows and columns are in the larger image if there is an offset
+    def add(self, rows, columns, z, visual, classification):
+        rows = np.asarray(rows) - self.row_offset
+        columns = np.asarray(columns) - self.column_offset
+        inside = (0 <= rows) & (rows < self.shape[0]) & (0 <= columns) & (columns < self.shape[1])
+        if not np.all(inside):
+            rows = rows[inside]
+            columns = columns[inside]
+            z = np.asarray(z)[inside]
+            visual = np.asarray(visual)[inside]
+            classification = np.asarray(classification)[inside]
+        if len(rows) == 0:
+            return
+
+        if 'surface' in self._statistics:
+            self._statistics['surface'].add(rows, columns, z)
+        if 'preview' in self._statistics:
+            self._statistics['preview'].add(rows, columns, visual)
+
+        pixels = rows.astype(np.int64) * self.shape[1] + columns
+        _add_at(self._count, pixels)
+        for c, counts in self._class_counts.items():
+            is_class = classification == c
+            if np.any(is_class):
+                _add_at(counts, pixels[is_class])
+
+        if 'ground' in self._statistics or 'visual' in self._statistics:
+            ground = np.isin(classification, self.ground_classes)
+            if 'ground' in self._statistics:
+                ground_rows = rows[ground]
+                ground_columns = columns[ground]
+                ground_z = np.asarray(z)[ground]
+                self._statistics['ground'].add(ground_rows, ground_columns, ground_z)
+                if self.downsample_levels and len(ground_rows) > 0:
+                    _add_at(self._ground_count, ground_rows.astype(np.int64) * self.shape[1] + ground_columns)
+                for level, statistic in enumerate(self._ground_levels, 1):
+                    statistic.add(ground_rows >> level, ground_columns >> level, ground_z)
+            if 'visual' in self._statistics:
+                self._statistics['visual'].add(rows[ground], columns[ground], np.asarray(visual)[ground])
+
+    # Returns a dictionary of the layers, see above
+    def result(self):
+        layers = {name: statistic.result() for name, statistic in self._statistics.items()}
+        if 'ground' in self._statistics:
+            if self.downsample_levels:
+                ground_count = self._ground_count.reshape(self.shape)
+                layers['ground_levels'] = [downsample_level(layers['ground'], ground_count, 2**level, self.ground_statistic) for level in range(1, self.ground_levels)]
+            else:
+                layers['ground_levels'] = [statistic.result() for statistic in self._ground_levels]
+        layers['count'] = self._count.reshape(self.shape)
+        if 'class_counts' in self.layer_names:
+            layers['class_counts'] = {c: counts.reshape(self.shape) for c, counts in self._class_counts.items()}
+        return layers
+
+# Shape of an image of shape at a level that is 2**level times coarser, partial pixels at the right and top edges are kept
+def level_shape(shape, level):
+    return (-(-shape[0] // 2**level), -(-shape[1] // 2**level))
+
+# Shrinks an image by an integer ratio, each new pixel is the highest finite value of its ratio x ratio block
+# Pixels left over at the right and top edges are dropped
+def block_max(image, ratio):
+    height = image.shape[0] // ratio
+    width = image.shape[1] // ratio
+    blocks = image[:height*ratio, :width*ratio].reshape(height, ratio, width, ratio)
+    # fmax ignores nan unless the whole block is nan
+    return np.fmax.reduce(np.fmax.reduce(blocks, axis=3), axis=1)
+
+# Shrinks an image by an integer ratio, each new pixel is the mean of its ratio x ratio block weighted by counts
+# Partial blocks at the right and top edges are kept
+# Used to make a mean layer coarser, weighting by the point counts gives the same mean as rasterizing at the coarse scale
+def block_mean(image, counts, ratio):
+    height = -(-image.shape[0] // ratio)
+    width = -(-image.shape[1] // ratio)
+    weights = np.zeros((height*ratio, width*ratio), np.float64)
+    sums = np.zeros((height*ratio, width*ratio), np.float64)
+    valid = np.isfinite(image) & (counts > 0)
+    weights[:image.shape[0], :image.shape[1]][valid] = counts[valid]
+    sums[:image.shape[0], :image.shape[1]][valid] = image[valid] * weights[:image.shape[0], :image.shape[1]][valid]
+    weights = weights.reshape(height, ratio, width, ratio).sum(axis=(1, 3))
+    sums = sums.reshape(height, ratio, width, ratio).sum(axis=(1, 3))
+    coarse = np.full((height, width), math.nan, np.float32)
+    coarse[weights > 0] = sums[weights > 0] / weights[weights > 0]
+    return coarse
+
+# Shrinks a layer made with statistic by an integer ratio, partial blocks at the right and top edges are kept
+# min and max are the same as rasterizing at the coarse scale, mean is too when counts are the number of values in each pixel
+# A percentile can't be made from the percentiles of the blocks, it becomes their mean weighted by counts
+def downsample_level(image, counts, ratio, statistic):
+    if statistic not in ['min', 'max']:
+        return block_mean(image, counts, ratio)
+    height = -(-image.shape[0] // ratio)
+    width = -(-image.shape[1] // ratio)
+    padded = np.full((height*ratio, width*ratio), math.nan, np.float32)
+    padded[:image.shape[0], :image.shape[1]] = image
+    blocks = padded.reshape(height, ratio, width, ratio)
+    # fmin and fmax ignore nan unless the whole block is nan
+    reduce = np.fmin.reduce if statistic == 'min' else np.fmax.reduce
+    return reduce(reduce(blocks, axis=3), axis=1)
+
+# Empty layer like the one named name that RasterAccumulator.result() returns
+def empty_layer(name, shape, counted_classes=[], ground_levels=1):
+    if name == 'count':
+        return np.zeros(shape, np.uint32)
+    if name == 'class_counts':
+        return {c: np.zeros(shape, np.uint32) for c in counted_classes}
+    if name == 'ground_levels':
+        return [np.full(level_shape(shape, level), math.nan, np.float32) for level in range(1, ground_levels)]
+    return np.full(shape, math.nan, np.float32)
+
+# Empty layers like RasterAccumulator.result() returns, to stitch tiles into
+def empty_layers(shape, counted_classes=[], layer_names=None, ground_levels=1):
+    if layer_names is None:
+        layer_names = all_layer_names
+    names = [name for name in ['ground', 'visual', 'surface', 'preview'] if name in layer_names]
+    if 'ground' in layer_names:
+        names.append('ground_levels')
+    names.append('count')
+    if 'class_counts' in layer_names:
+        names.append('class_counts')
+    return {name: empty_layer(name, shape, counted_classes, ground_levels) for name in names}
+
+# Returns views of the pixels lower_row <= row < upper_row and lower_column <= column < upper_column of every layer
+# The coarser ground levels keep every pixel that overlaps the crop, lower_row and lower_column must be multiples of their pixel size
+def crop_layers(layers, lower_row, upper_row, lower_column, upper_column):
+    cropped = {name: layer[lower_row:upper_row, lower_column:upper_column] for name, layer in layers.items() if name not in ['class_counts', 'ground_levels']}
+    if 'class_counts' in layers:
+        cropped['class_counts'] = {c: counts[lower_row:upper_row, lower_column:upper_column] for c, counts in layers['class_counts'].items()}
+    if 'ground_levels' in layers:
+        level_pixels = 2**len(layers['ground_levels'])
+        if lower_row % level_pixels != 0 or lower_column % level_pixels != 0:
+            raise ValueError("Crop at " + str((lower_row, lower_column)) + " doesn't line up with " + str(len(layers['ground_levels'])) + " ground levels")
+        cropped['ground_levels'] = [image[lower_row >> level:-(-upper_row // 2**level), lower_column >> level:-(-upper_column // 2**level)] \
+                                    for level, image in enumerate(layers['ground_levels'], 1)]
+    return cropped
+
+# Copies the layers of a tile into the larger layers with its lower left pixel at row, column
+# row and column must be multiples of the pixel size of the coarsest ground level
+def paste_layers(layers, tile_layers, row, column):
+    for name, tile_layer in tile_layers.items():
+        if name == 'class_counts':
+            for c, counts in tile_layer.items():
+                layers[name][c][row:row+counts.shape[0], column:column+counts.shape[1]] = counts
+        elif name == 'ground_levels':
+            for level, image in enumerate(tile_layer, 1):
+                layers[name][level-1][row >> level:(row >> level)+image.shape[0], column >> level:(column >> level)+image.shape[1]] = image
+        else:
+            layers[name][row:row+tile_layer.shape[0], column:column+tile_layer.shape[1]] = tile_layer
+
+# Same layers as one RasterAccumulator over every point, but each tile_pixels x tile_pixels tile of the image is
+# rasterized separately in a thread pool and then stitched together
+# tile_points(lower_row, upper_row, lower_column, upper_column) returns an iterable of chunks of the points in those pixels,
+# each chunk is the rows, columns, z, visual and classification arrays passed to RasterAccumulator.add
+# Every pixel belongs to exactly one tile and the layers don't depend on point order, so the result is identical for any number of workers
+# workers of None uses every core, numpy releases the GIL for the heavy work
+# row_offset and column_offset rasterize only shape pixels starting from there, tile_points is still given pixels of the full image
+# The ground levels of the tiles are stitched too, so tile_pixels must be a multiple of the pixel size of the coarsest level
+def rasterize_tiles(shape, tile_points, ground_classes, counted_classes=[], tile_pixels=1024, workers=None, row_offset=0, column_offset=0, printf=print, \
+                    **accumulator_options):
+    ground_levels = accumulator_options.get('ground_levels', 1)
+    if tile_pixels % 2**(ground_levels - 1) != 0:
+        raise ValueError("Tiles of " + str(tile_pixels) + " pixels can't hold " + str(ground_levels) + " ground levels")
+    tiles = [(row, column) for row in range(0, shape[0], tile_pixels) for column in range(0, shape[1], tile_pixels)]
+
+    def rasterize_tile(tile):
+        row, column = tile
+        tile_shape = (min(tile_pixels, shape[0] - row), min(tile_pixels, shape[1] - column))
+        accumulator = RasterAccumulator(tile_shape, ground_classes, counted_classes=counted_classes, row_offset=row_offset+row, column_offset=column_offset+column, \
+                                        **accumulator_options)
+        for chunk in tile_points(row_offset + row, row_offset + row + tile_shape[0], column_offset + column, column_offset + column + tile_shape[1]):
+            accumulator.add(*chunk)
+        return accumulator.result()
+
+    layers = empty_layers(shape, counted_classes, accumulator_options.get('layer_names'), ground_levels)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    last_print_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Only a few tiles are kept in flight so finished tiles can be stitched and freed
+        pending = {}
+        next_tile = 0
+        finished = 0
+        while next_tile < len(tiles) or pending:
+            while next_tile < len(tiles) and len(pending) < 2*workers:
+                pending[executor.submit(rasterize_tile, tiles[next_tile])] = tiles[next_tile]
+                next_tile += 1
+            done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                paste_layers(layers, future.result(), *pending.pop(future))
+                finished += 1
+            if time.time() > last_print_time + 1.0:
+                last_print_time = time.time()
+                printf(str(round(100.0*float(finished) / len(tiles), 2)) + "% rasterizing lidar")
+    return layers
+
+# RasterAccumulator that doesn't need to know the size of the image up front
+# Tiles of tile_pixels x tile_pixels pixels are created as points land in them, rows and columns may be negative
+# Memory depends on the area covered by points, not on the number of points (except for percentile layers)
+# Ground levels are aligned to multiples of their pixel size, like the tiles
+class GrowingRasterAccumulator:
+    def __init__(self, ground_classes, counted_classes=[], tile_pixels=1024, **accumulator_options):
+        if tile_pixels % 2**(accumulator_options.get('ground_levels', 1) - 1) != 0:
+            raise ValueError("Tiles of " + str(tile_pixels) + " pixels can't hold " + str(accumulator_options['ground_levels']) + " ground levels")
+        self.ground_classes = ground_classes
+        self.counted_classes = counted_classes
+        self.tile_pixels = tile_pixels
+        self.accumulator_options = accumulator_options
+        self._tiles = {}
+
+    def add(self, rows, columns, z, visual, classification):
+        rows = np.asarray(rows)
+        columns = np.asarray(columns)
+        if len(rows) == 0:
+            return
+        tile_rows = np.floor_divide(rows, self.tile_pixels)
+        tile_columns = np.floor_divide(columns, self.tile_pixels)
+
+        # Group the points by tile so each tile gets one add call
+        tile_keys = (tile_rows.astype(np.int64) << 32) + (tile_columns.astype(np.int64) + 2**31)
+        order = np.argsort(tile_keys, kind='stable')
+        tile_keys = tile_keys[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(tile_keys)) + 1, [len(tile_keys)]))
+        for start, end in zip(starts[:-1], starts[1:]):
+            tile = (int(tile_rows[order[start]]), int(tile_columns[order[start]]))
+            accumulator = self._tiles.get(tile)
+            if accumulator is None:
+                accumulator = RasterAccumulator((self.tile_pixels, self.tile_pixels), self.ground_classes, counted_classes=self.counted_classes, \
+                                                row_offset=tile[0]*self.tile_pixels, column_offset=tile[1]*self.tile_pixels, **self.accumulator_options)
+                self._tiles[tile] = accumulator
+            points = order[start:end]
+            accumulator.add(rows[points], columns[points], np.asarray(z)[points], np.asarray(visual)[points], np.asarray(classification)[points])
+
+    # Returns the layers cropped to the pixels that have points, and the row and column of their lower left pixel
+    # The lower left pixel is moved down to a multiple of the coarsest ground level's pixel size so the levels still line up
+    # Returns None for the layers if nothing was added
+    # Tiles are finished and their accumulators freed one at a time, then the layers are stitched one at a time and freed from the tiles,
+    # so the accumulators, the finished tiles and the stitched layers are never all in memory at once
+    def result(self):
+        tile_layers = {}
+        while self._tiles:
+            tile, accumulator = self._tiles.popitem()
+            tile_layers[tile] = accumulator.result()
+            del accumulator
+
+        occupied = []
+        for (tile_row, tile_column), layers in tile_layers.items():
+            rows, columns = np.nonzero(layers['count'])
+            if len(rows) > 0:
+                occupied.append((tile_row*self.tile_pixels + np.amin(rows), tile_column*self.tile_pixels + np.amin(columns), \
+                                 tile_row*self.tile_pixels + np.amax(rows), tile_column*self.tile_pixels + np.amax(columns)))
+        if len(occupied) == 0:
+            return None, 0, 0
+
+        ground_levels = self.accumulator_options.get('ground_levels', 1)
+        level_pixels = 2**(ground_levels - 1)
+        lower_row = min(o[0] for o in occupied) // level_pixels * level_pixels
+        lower_column = min(o[1] for o in occupied) // level_pixels * level_pixels
+        upper_row = max(o[2] for o in occupied) + 1
+        upper_column = max(o[3] for o in occupied) + 1
+        shape = (upper_row - lower_row, upper_column - lower_column)
+
+        layers = {}
+        for name in list(next(iter(tile_layers.values())).keys()):
+            layers[name] = empty_layer(name, shape, self.counted_classes, ground_levels)
+            for (tile_row, tile_column), tile in tile_layers.items():
+                # Crop the tile to the part inside the layers
+                row = tile_row*self.tile_pixels - lower_row
+                column = tile_column*self.tile_pixels - lower_column
+                cropped = crop_layers({name: tile.pop(name)}, max(0, -row), max(0, min(self.tile_pixels, shape[0] - row)), \
+                                      max(0, -column), max(0, min(self.tile_pixels, shape[1] - column)))
+                paste_layers(layers, cropped, max(0, row), max(0, column))
+        return layers, lower_row, lower_column
@@ -22,6 +22,7 @@ from pathlib import Path
 import sys
 
 from GeoPointCloud import GeoPointCloud
+import heightmap_io
 from infill_image import infill_image_scipy
 import OSMTGC
 import tgc_tools
@@ -109,33 +110,36 @@ if __name__ == "__main__":
 
     print("Loading data")
 
+    heightmap_file = heightmap_io.open_heightmap(lidar_dir_path + '/lidar')
+
     # See if we need to infill.
-    hm_file = Path(lidar_dir_path) / 'lidar/heightmap.npy'
+    hm_file = Path(heightmap_file.path)
     in_file = Path(lidar_dir_path) / 'lidar/infilled.npy'
 
     if not in_file.exists() or hm_file.stat().st_mtime > in_file.stat().st_mtime:
         print("Filling holes in heightmap")
-        # Either infilled doesn't exist or heightmap.npy is newer than infilled
-        read_dictionary = np.load(lidar_dir_path + '/lidar/heightmap.npy').item()
-        im = read_dictionary['heightmap'].astype('float32')
+        # Either infilled doesn't exist or the heightmap is newer than infilled
+        im = np.array(heightmap_file.heightmap(), np.float32)
 
         mask = cv2.imread(lidar_dir_path + '/lidar/mask.png', cv2.IMREAD_COLOR)
 
         # Process Image
-        out, holeMask = infill_image_scipy(im, mask)
+        heightmap, background, holeMask = infill_image_scipy(im, mask, background_ratio=None)
 
-        # Export data
-        read_dictionary['heightmap'] = out
-        np.save(lidar_dir_path + '/lidar/infilled', read_dictionary) # Save as numpy format since we have raw float elevations
+        # Export data, only the infilled elevations since everything else is in the heightmap files
+        np.save(lidar_dir_path + '/lidar/infilled', heightmap.astype(np.float32)) # Save as numpy format since we have raw float elevations
     else:
-        read_dictionary = np.load(lidar_dir_path + '/lidar/infilled.npy').item()
+        try:
+            heightmap = np.load(lidar_dir_path + '/lidar/infilled.npy', mmap_mode='r')
+        except ValueError:
+            # Older versions saved the whole pickled heightmap dictionary with the infilled elevations in it
+            heightmap = np.load(lidar_dir_path + '/lidar/infilled.npy', allow_pickle=True).item()['heightmap']
 
-    image_scale = read_dictionary["image_scale"]
-    intensity_image = read_dictionary['visual']
-    heightmap = read_dictionary['heightmap']
+    image_scale = heightmap_file.image_scale
+    intensity_image = heightmap_file.visual()
 
     pc = GeoPointCloud()
-    pc.addFromImage(heightmap, image_scale, read_dictionary['origin'], read_dictionary['projection'])
+    pc.addFromImage(heightmap, image_scale, heightmap_file.origin, heightmap_file.projection)
 
     offsets = getManualRegistrationError(intensity_image, heightmap, image_scale, pc)
 
@@ -0,0 +1,189 @@
+import collections
+import math
+import numpy as np
+import pytest
+
+import lidar_raster
+
+ground_classes = [2, 8]
+counted_classes = [2, 5]
+
+# Random points with several points in most pixels, some pixels are left empty
+def make_points(seed, shape, count, row_offset=0, column_offset=0):
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, shape[0], count) + row_offset
+    columns = rng.integers(0, shape[1], count) + column_offset
+    z = rng.normal(200.0, 5.0, count).astype(np.float32)
+    visual = rng.integers(0, 3000, count).astype(np.float32)
+    classification = rng.choice([1, 2, 3, 5, 8], count)
+    return rows, columns, z, visual, classification
+
+# Reduces the values of each pixel one pixel at a time, the way the lidar was rasterized before
+def naive_statistic(rows, columns, values, shape, reduce):
+    pixels = collections.defaultdict(list)
+    for row, column, value in zip(rows, columns, values):
+        if 0 <= row < shape[0] and 0 <= column < shape[1]:
+            pixels[(row, column)].append(float(value))
+    image = np.full(shape, math.nan, np.float32)
+    for (row, column), pixel_values in pixels.items():
+        image[row, column] = reduce(np.array(pixel_values, np.float64))
+    return image
+
+def assert_layers_equal(expected, actual):
+    assert sorted(expected.keys()) == sorted(actual.keys())
+    for name, layer in expected.items():
+        if name == 'class_counts':
+            for c in layer:
+                np.testing.assert_array_equal(layer[c], actual[name][c])
+        elif name == 'ground_levels':
+            assert len(layer) == len(actual[name])
+            for expected_level, actual_level in zip(layer, actual[name]):
+                np.testing.assert_array_equal(expected_level, actual_level)
+        else:
+            np.testing.assert_array_equal(layer, actual[name])
+
+@pytest.mark.parametrize('statistic, percentile, reduce', [
+    ('min', 50.0, np.min),
+    ('max', 50.0, np.max),
+    ('mean', 50.0, np.mean),
+    ('percentile', 25.0, lambda values: np.percentile(values, 25.0)),
+    ('percentile', 50.0, np.median),
+    ('percentile', 100.0, np.max),
+])
+def test_bin_statistic_matches_per_pixel_reference(statistic, percentile, reduce):
+    shape = (13, 17)
+    # A few points land outside of the image and are ignored
+    rows, columns, z, visual, classification = make_points(1, (15, 19), 3000, -1, -1)
+    image = lidar_raster.bin_statistic(rows, columns, z, shape, statistic=statistic, percentile=percentile)
+    expected = naive_statistic(rows, columns, z, shape, reduce)
+    np.testing.assert_array_equal(np.isnan(expected), np.isnan(image))
+    np.testing.assert_allclose(image, expected, rtol=1e-6, equal_nan=True)
+
+def test_binned_statistic_does_not_depend_on_chunks_or_order():
+    shape = (9, 11)
+    rows, columns, z, visual, classification = make_points(2, shape, 2000)
+    for statistic in lidar_raster.statistics:
+        whole = lidar_raster.bin_statistic(rows, columns, z, shape, statistic=statistic, percentile=25.0)
+        binned = lidar_raster.BinnedStatistic(shape, statistic=statistic, percentile=25.0)
+        order = np.random.default_rng(3).permutation(len(z))
+        for chunk in np.array_split(order, 7):
+            binned.add(rows[chunk], columns[chunk], z[chunk])
+        np.testing.assert_array_equal(whole, binned.result())
+
+def test_raster_accumulator_matches_per_pixel_reference():
+    shape = (12, 10)
+    rows, columns, z, visual, classification = make_points(4, shape, 2500)
+    accumulator = lidar_raster.RasterAccumulator(shape, ground_classes, counted_classes=counted_classes, ground_statistic='percentile', \
+                                                 ground_percentile=25.0, visual_statistic='mean')
+    accumulator.add(rows, columns, z, visual, classification)
+    layers = accumulator.result()
+
+    ground = np.isin(classification, ground_classes)
+    np.testing.assert_allclose(layers['ground'], naive_statistic(rows[ground], columns[ground], z[ground], shape, lambda v: np.percentile(v, 25.0)), \
+                               rtol=1e-6, equal_nan=True)
+    np.testing.assert_allclose(layers['visual'], naive_statistic(rows[ground], columns[ground], visual[ground], shape, np.mean), rtol=1e-6, equal_nan=True)
+    np.testing.assert_array_equal(layers['surface'], naive_statistic(rows, columns, z, shape, np.max))
+    np.testing.assert_allclose(layers['preview'], naive_statistic(rows, columns, visual, shape, np.mean), rtol=1e-6, equal_nan=True)
+    expected_count = np.zeros(shape, np.uint32)
+    np.add.at(expected_count, (rows, columns), 1)
+    np.testing.assert_array_equal(layers['count'], expected_count)
+    for c in counted_classes:
+        expected_class_count = np.zeros(shape, np.uint32)
+        np.add.at(expected_class_count, (rows[classification == c], columns[classification == c]), 1)
+        np.testing.assert_array_equal(layers['class_counts'][c], expected_class_count)
+
+def test_ground_levels_match_binning_at_the_coarser_scale():
+    shape = (16, 24)
+    rows, columns, z, visual, classification = make_points(5, shape, 4000)
+    ground = np.isin(classification, ground_classes)
+    for downsample_levels, statistic in [(False, 'percentile'), (False, 'mean'), (True, 'min'), (True, 'max'), (True, 'mean')]:
+        accumulator = lidar_raster.RasterAccumulator(shape, ground_classes, ground_statistic=statistic, ground_percentile=25.0, \
+                                                     ground_levels=3, downsample_levels=downsample_levels)
+        accumulator.add(rows, columns, z, visual, classification)
+        layers = accumulator.result()
+        assert len(layers['ground_levels']) == 2
+        for level, image in enumerate(layers['ground_levels'], 1):
+            expected = lidar_raster.bin_statistic(rows[ground] >> level, columns[ground] >> level, z[ground], lidar_raster.level_shape(shape, level), \
+                                                  statistic=statistic, percentile=25.0)
+            np.testing.assert_allclose(image, expected, rtol=1e-6, equal_nan=True)
+
+def test_block_mean_matches_binning_at_the_coarser_scale():
+    # The shape isn't a multiple of the ratio, so there are partial blocks
+    shape = (13, 18)
+    rows, columns, z, visual, classification = make_points(6, shape, 3000)
+    fine = lidar_raster.bin_statistic(rows, columns, visual, shape, statistic='mean')
+    counts = np.zeros(shape, np.uint32)
+    np.add.at(counts, (rows, columns), 1)
+    coarse = lidar_raster.block_mean(fine, counts, 4)
+    expected = lidar_raster.bin_statistic(rows // 4, columns // 4, visual, lidar_raster.level_shape(shape, 2), statistic='mean')
+    np.testing.assert_allclose(coarse, expected, rtol=1e-6, equal_nan=True)
+
+@pytest.mark.parametrize('tile_pixels, workers', [(4, 1), (8, 3), (64, 2)])
+def test_tiled_rasterization_matches_one_pass(tile_pixels, workers):
+    shape = (30, 21)
+    row_offset = 8
+    column_offset = 4
+    # Points all around the rasterized pixels, the ones outside of them are ignored
+    rows, columns, z, visual, classification = make_points(7, (40, 30), 6000)
+    options = {'ground_statistic': 'percentile', 'ground_percentile': 25.0, 'visual_statistic': 'mean', 'ground_levels': 3}
+
+    accumulator = lidar_raster.RasterAccumulator(shape, ground_classes, counted_classes=counted_classes, row_offset=row_offset, column_offset=column_offset, \
+                                                 **options)
+    accumulator.add(rows, columns, z, visual, classification)
+    expected = accumulator.result()
+
+    def tile_points(lower_row, upper_row, lower_column, upper_column):
+        inside = np.flatnonzero((lower_row <= rows) & (rows < upper_row) & (lower_column <= columns) & (columns < upper_column))
+        # More than one chunk per tile
+        for chunk in np.array_split(inside, 3):
+            yield rows[chunk], columns[chunk], z[chunk], visual[chunk], classification[chunk]
+
+    tiled = lidar_raster.rasterize_tiles(shape, tile_points, ground_classes, counted_classes=counted_classes, tile_pixels=tile_pixels, workers=workers, \
+                                         row_offset=row_offset, column_offset=column_offset, printf=lambda message: None, **options)
+    assert_layers_equal(expected, tiled)
+
+def test_tiles_must_hold_the_ground_levels():
+    with pytest.raises(ValueError):
+        lidar_raster.rasterize_tiles((8, 8), lambda *bounds: [], ground_classes, tile_pixels=6, ground_levels=3)
+    with pytest.raises(ValueError):
+        lidar_raster.GrowingRasterAccumulator(ground_classes, tile_pixels=6, ground_levels=3)
+
+@pytest.mark.parametrize('tile_pixels', [4, 8, 1024])
+def test_growing_accumulator_matches_fixed_extent(tile_pixels):
+    # Points on both sides of zero, the growing accumulator doesn't know the extent up front
+    rows, columns, z, visual, classification = make_points(8, (23, 29), 5000, -9, -13)
+    options = {'ground_statistic': 'min', 'visual_statistic': 'mean', 'ground_levels': 3, 'downsample_levels': True}
+
+    growing = lidar_raster.GrowingRasterAccumulator(ground_classes, counted_classes=counted_classes, tile_pixels=tile_pixels, **options)
+    for chunk in np.array_split(np.random.default_rng(9).permutation(len(z)), 4):
+        growing.add(rows[chunk], columns[chunk], z[chunk], visual[chunk], classification[chunk])
+    layers, lower_row, lower_column = growing.result()
+
+    # The lower left pixel is moved down to line up with the coarsest level
+    assert (lower_row, lower_column) == (-12, -16)
+    shape = layers['count'].shape
+    assert shape == (rows.max() + 1 - lower_row, columns.max() + 1 - lower_column)
+
+    fixed = lidar_raster.RasterAccumulator(shape, ground_classes, counted_classes=counted_classes, row_offset=lower_row, column_offset=lower_column, **options)
+    fixed.add(rows, columns, z, visual, classification)
+    assert_layers_equal(fixed.result(), layers)
+
+def test_growing_accumulator_without_points():
+    growing = lidar_raster.GrowingRasterAccumulator(ground_classes)
+    growing.add(np.zeros(0, np.int64), np.zeros(0, np.int64), [], [], [])
+    assert growing.result() == (None, 0, 0)
+
+def test_crop_and_paste_keep_the_ground_levels_aligned():
+    shape = (16, 20)
+    rows, columns, z, visual, classification = make_points(10, shape, 3000)
+    accumulator = lidar_raster.RasterAccumulator(shape, ground_classes, counted_classes=counted_classes, ground_levels=3)
+    accumulator.add(rows, columns, z, visual, classification)
+    layers = accumulator.result()
+
+    cropped = lidar_raster.crop_layers(layers, 4, 13, 8, 20)
+    pasted = lidar_raster.empty_layers(shape, counted_classes, ground_levels=3)
+    lidar_raster.paste_layers(pasted, cropped, 4, 8)
+    np.testing.assert_array_equal(pasted['ground'][4:13, 8:20], layers['ground'][4:13, 8:20])
+    np.testing.assert_array_equal(pasted['ground_levels'][1][1:4, 2:5], layers['ground_levels'][1][1:4, 2:5])
+    with pytest.raises(ValueError):
+        lidar_raster.crop_layers(layers, 2, 13, 8, 20)
@@ -0,0 +1,49 @@
+import numpy as np
+import pyproj
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('overpy')
+
+import OSMTGC
+from GeoPointCloud import GeoPointCloud
+
+class FakeNode:
+    def __init__(self, lat, lon):
+        self.lat = lat
+        self.lon = lon
+
+class FakeWay:
+    def __init__(self, golf_type, nodes):
+        self.tags = {'golf': golf_type}
+        self._nodes = nodes
+
+    def get_nodes(self, resolve_missing=False):
+        return self._nodes
+
+def make_way(pc, golf_type, rows, columns, image_scale):
+    lat, lon = pc.cv2ToLatLonArray(np.asarray(rows, np.float64), np.asarray(columns, np.float64), image_scale)
+    return FakeWay(golf_type, [FakeNode(a, o) for a, o in zip(lat, lon)])
+
+# The mask is drawn starting at the selection, it must match cropping a mask of the whole pointcloud
+def test_cropped_mask_matches_full_mask():
+    image_scale = 0.5
+    pc = GeoPointCloud()
+    pc.proj = pyproj.Proj(proj='utm', zone=17, ellps='WGS84')
+    pc.origin = (500000.0, 4000000.0)
+
+    ways = [make_way(pc, 'green', [20, 20, 70, 70], [30, 90, 90, 30], image_scale),
+            # Crosses the lower left corner of the selection
+            make_way(pc, 'bunker', [5, 5, 35, 35], [10, 50, 50, 10], image_scale),
+            # Inside the green, drawn on top of it
+            make_way(pc, 'bunker', [40, 40, 55, 55], [50, 70, 70, 50], image_scale)]
+
+    full = OSMTGC.addOSMToImage(ways, np.zeros((100, 120, 3), np.float32), pc, image_scale)
+
+    lower_row, upper_row, lower_column, upper_column = 16, 80, 24, 110
+    cropped = np.zeros((upper_row - lower_row, upper_column - lower_column, 3), np.float32)
+    cropped = OSMTGC.addOSMToImage(ways, cropped, pc, image_scale, x_offset=-lower_column*image_scale, y_offset=-lower_row*image_scale)
+
+    bunker_color = np.array([0.85, 0.85, 0.7], np.float32)
+    assert np.any(np.all(cropped == bunker_color, axis=2))
+    np.testing.assert_array_equal(cropped, full[lower_row:upper_row, lower_column:upper_column])
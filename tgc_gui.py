@@ -851,6 +851,18 @@ fillWaterCheck.deselect()
 options_entries_dict["purge_water"] = tk.BooleanVar()
 purgeWaterCheck = Checkbutton(courseSubFrame, text="Remove All Terrain Under Blue Mask", variable=options_entries_dict["purge_water"], fg=check_fg, bg=check_bg)
 purgeWaterCheck.deselect()
+levelentry = tk.Entry(courseSubFrame, width=10, justify='center')
+levelentry.insert(END, '0')
+options_entries_dict["heightmap_level"] = levelentry
+options_entries_dict["fill_from_levels"] = tk.BooleanVar()
+fillLevelsCheck = Checkbutton(courseSubFrame, text="Fill Holes From Coarser Heightmap Levels", variable=options_entries_dict["fill_from_levels"], fg=check_fg, bg=check_bg)
+fillLevelsCheck.deselect()
+options_entries_dict["infill_holes_only"] = tk.BooleanVar()
+holesOnlyCheck = Checkbutton(courseSubFrame, text="Only Fill Missing Terrain (Faster)", variable=options_entries_dict["infill_holes_only"], fg=check_fg, bg=check_bg)
+holesOnlyCheck.deselect()
+options_entries_dict["harmonic_infill"] = tk.BooleanVar()
+harmonicCheck = Checkbutton(courseSubFrame, text="Smooth Fill of All Missing Terrain (Fastest)", variable=options_entries_dict["harmonic_infill"], fg=check_fg, bg=check_bg)
+harmonicCheck.deselect()
 
 # Pack the osmControlFrame
 courseSubFrame.pack(padx=5, pady=5, fill=X, expand=True)
@@ -861,6 +873,11 @@ lidarTreeCheck.grid(row=2, columnspan=2, sticky=W, padx=5)
 treeVarietyCheck.grid(row=3, columnspan=2, sticky=W, padx=5)
 fillWaterCheck.grid(row=4, columnspan=2, sticky=W, padx=5)
 purgeWaterCheck.grid(row=5, columnspan=2, sticky=W, padx=5)
+Label(courseSubFrame, text="Heightmap Level (0 is Full Detail)", fg=check_fg, bg=check_bg).grid(row=6, column=0, sticky=W, padx=5)
+levelentry.grid(row=6, column=1, sticky=W, padx=5)
+fillLevelsCheck.grid(row=7, columnspan=2, sticky=W, padx=5)
+holesOnlyCheck.grid(row=8, columnspan=2, sticky=W, padx=5)
+harmonicCheck.grid(row=9, columnspan=2, sticky=W, padx=5)
 
 # Pack the two option frames side by side
 osmControlFrame.pack(side=LEFT, anchor=N, padx=5)
@@ -9,12 +9,15 @@ import sys
 import time
 
 from GeoPointCloud import GeoPointCloud
+import heightmap_io
 from infill_image import infill_image_scipy
 import OSMTGC
 import tgc_definitions
 import tgc_tools
 
 status_print_duration = 1.0 # Print progress every n seconds
+infill_tile_size = None # None fills the whole heightmap at once, a number of pixels fills it in overlapping tiles of that size to limit memory
+infill_workers = None # Threads used to fill the tiles, None uses every core
 
 def get_pixel(x_pos, z_pos, height, scale, brush_type=72):
     output = json.loads('{"tool":0,"position":{"x":0.0,"y":"-Infinity","z":0.0},"rotation":{"x":0.0,"y":0.0,"z":0.0},"_orientation":0.0,"scale":{"x":1.0, \
@@ -110,22 +113,55 @@ def get_trees(theme, tree_variety, trees):
             output.append(g)
     return output
 
+# lidar_trees is an array of heightmap_io.tree_dtype
 def get_lidar_trees(theme, tree_variety, lidar_trees, pc, mask, mask_pc, image_scale):
     # Convert to TGC coordinates
+    eastings = lidar_trees['easting']
+    northings = lidar_trees['northing']
+    rows, columns = mask_pc.projToCV2Array(eastings, northings, image_scale)
+    # Use standard pointcloud tp project trees into final TGC coordinates
+    xs, ys, zs = pc.projToTGCArray(eastings, northings, 0.0)
+
     trees = []
-    for tree in lidar_trees:
-        easting, northing, r, h = tree
+    for row, column, x, z, r, h in zip(rows, columns, xs.tolist(), zs.tolist(), lidar_trees['radius'].tolist(), lidar_trees['height'].tolist()):
         # Use mask to only add trees on desired areas
-        row, column = mask_pc.projToCV2(easting, northing, image_scale)
         mask_color = mask[(row, column)]
         # Color order is BGR, support both MS Paint Red Colors
         if not (mask_color[0] < 40 and mask_color[1] < 40 and mask_color[2] > 130):
-            # Use standard pointcloud tp project trees into final TGC coordinates
-            x, y, z = pc.projToTGC(easting, northing, 0.0)
             trees.append((x, z, r, h))
 
     return get_trees(theme, tree_variety, trees)
 
+# Returns the heightmap level chosen in the course options, within the num_levels saved levels
+# Values that aren't whole numbers or are out of range are reported and replaced with the nearest valid level
+def get_level_option(options_dict, num_levels, printf=print):
+    value = options_dict.get('heightmap_level', 0)
+    try:
+        level = int(value)
+    except (TypeError, ValueError):
+        printf("Heightmap level must be a whole number, not: " + str(value) + ", using level 0")
+        return 0
+    valid_level = min(max(level, 0), num_levels - 1)
+    if valid_level != level:
+        printf("Heightmap level " + str(level) + " was not saved, using level " + str(valid_level) + " (levels 0 to " + str(num_levels - 1) + " are available)")
+    return valid_level
+
+# Returns a copy of a level of the heightmap_io.HeightmapFile saved by lidar_map_api.generate_lidar_heightmap
+# Level 0 is full resolution, each level after it has pixels twice as large
+# fill_from_levels fills pixels without elevation from the coarser levels, which average more points and have fewer holes
+def get_heightmap_level(heightmap_file, level, fill_from_levels=False):
+    heightmap = np.array(heightmap_file.heightmap(level), np.float32)
+    if fill_from_levels:
+        for coarse_level in range(level+1, len(heightmap_file.levels)):
+            missing = np.isnan(heightmap[:,:,0])
+            if not np.any(missing):
+                break
+            # Each coarse pixel covers 2**ratio x 2**ratio pixels of this level
+            ratio = coarse_level - level
+            rows, columns = np.nonzero(missing)
+            heightmap[rows, columns, 0] = heightmap_file.heightmap(coarse_level)[rows >> ratio, columns >> ratio, 0]
+    return heightmap
+
 # Set various constants that we need
 def set_constants(course_json, flatten_fairways=False, flatten_greens=False, course_latitude=None, printf=print):
     # These only work if the terrain is made from scult (red brushes) rather than landscape (blue brushes)
@@ -175,18 +211,22 @@ def generate_course(course_json, heightmap_dir_path, options_dict={}, printf=pri
     printf("Loading data from " + heightmap_dir_path)
 
     # Infill data to prevent holes and make the data nice and smooth
-    hm_file = Path(heightmap_dir_path) / '/heightmap.npy'
     try:
-        read_dictionary = np.load(heightmap_dir_path + '/heightmap.npy').item()
-        im = read_dictionary['heightmap'].astype('float32')
+        heightmap_file = heightmap_io.open_heightmap(heightmap_dir_path)
+        level = get_level_option(options_dict, len(heightmap_file.levels), printf=printf)
+        im = get_heightmap_level(heightmap_file, level, options_dict.get('fill_from_levels', False))
+        image_scale = heightmap_file.levels[level]['image_scale']
+        origin = heightmap_file.levels[level]['origin']
 
         mask = cv2.imread(heightmap_dir_path + '/mask.png', cv2.IMREAD_COLOR)
         # Turn mask into matrix order from image order
         mask = np.flip(mask, 0)
+        if mask.shape[:2] != im.shape[:2]:
+            # The mask is drawn at full resolution, use the color at each coarse pixel so it stays one of the mask colors
+            mask = cv2.resize(mask, (im.shape[1], im.shape[0]), interpolation=cv2.INTER_NEAREST)
 
         # Process Image
         printf("Filling holes in heightmap")
-        image_scale = read_dictionary['image_scale']
         printf("Map scale is: " + str(image_scale) + " meters")
         background_ratio = None
         if options_dict.get('add_background', False):
@@ -194,56 +234,59 @@ def generate_course(course_json, heightmap_dir_path, options_dict={}, printf=pri
             background_ratio = background_scale/image_scale
             printf("Background requested with scale: " + str(background_scale) + " meters")
             
-        heightmap, background, holeMask = infill_image_scipy(im, mask, background_ratio=background_ratio, fill_water=options_dict.get('fill_water', False), purge_water=options_dict.get('purge_water', False), printf=printf)
+        heightmap, background, holeMask = infill_image_scipy(im, mask, background_ratio=background_ratio, fill_water=options_dict.get('fill_water', False), purge_water=options_dict.get('purge_water', False), \
+                                                             holes_only=options_dict.get('infill_holes_only', False), tile_pixels=infill_tile_size, workers=infill_workers, \
+                                                             method='harmonic' if options_dict.get('harmonic_infill', False) else 'griddata', printf=printf)
     except FileNotFoundError:
         printf("Could not find heightmap or mask at: " + heightmap_dir_path)
         return course_json
 
     # Clear existing terrain
-    course_json = set_constants(course_json, options_dict.get('flatten_fairways', False), options_dict.get('flatten_greens', False), read_dictionary['origin'][0], printf=printf)
+    course_json = set_constants(course_json, options_dict.get('flatten_fairways', False), options_dict.get('flatten_greens', False), origin[0], printf=printf)
     course_json["userLayers"]["height"] = []
     course_json["userLayers"]["terrainHeight"] = []
     course_json["placedObjects2"] = []
 
     # Construct high resolution model
     pc = GeoPointCloud()
-    pc.addFromImage(heightmap, image_scale, read_dictionary['origin'], read_dictionary['projection'])
+    pc.addFromImage(heightmap, image_scale, origin, heightmap_file.projection)
 
     # Add low resolution background
     if background is not None:
         background_pc = GeoPointCloud()
-        background_pc.addFromImage(background, background_scale, read_dictionary['origin'], read_dictionary['projection'])
-        num_points = len(background_pc.points())
+        background_pc.addFromImage(background, background_scale, origin, heightmap_file.projection)
+        num_points = background_pc.count
         last_print_time = time.time()
 
-        for n, i in enumerate(background_pc.points()):
+        # Convert to projected coordinates, then project to TGC using the high resolution pointcloud to ensure alignment
+        eastings, northings = background_pc.enuToProjArray(background_pc.x, background_pc.y)
+        xs, ys, zs = pc.projToTGCArray(eastings, northings, 0.0)
+        for n, (x, z, elevation) in enumerate(zip(xs.tolist(), zs.tolist(), background_pc.z.tolist())):
             if time.time() > last_print_time + status_print_duration:
                 last_print_time = time.time()
                 printf(str(round(100.0*float(n) / num_points, 2)) + "% through heightmap")
 
-            # Convert to projected coordinates, then project to TGC using the high resolution pointcloud to ensure alignment
-            easting, northing = background_pc.enuToProj(i[0], i[1])
-            x, y, z = pc.projToTGC(easting, northing, 0.0)
             # Using 10 - the very soft circles means we need to scale 2.5x more to fill and smooth the terrain
-            course_json["userLayers"]["height"].append(get_pixel(x, z, i[2], 2.5*background_scale, brush_type=10))
+            course_json["userLayers"]["height"].append(get_pixel(x, z, elevation, 2.5*background_scale, brush_type=10))
 
     # Convert the pointcloud into height elements
-    num_points = len(pc.points())
+    num_points = pc.count
     last_print_time = time.time()
-    for n, i in enumerate(pc.points()):
+    xs, ys, zs = pc.enuToTGCArray(pc.x, pc.y, 0.0) # Don't transform y, it's inverted from elevation
+    for n, (x, z, elevation) in enumerate(zip(xs.tolist(), zs.tolist(), pc.z.tolist())):
         if time.time() > last_print_time + status_print_duration:
             last_print_time = time.time()
             printf(str(round(100.0*float(n) / num_points, 2)) + "% through heightmap")
 
-        x, y, z = pc.enuToTGC(i[0], i[1], 0.0) # Don't transform y, it's inverted from elevation
-        course_json["userLayers"]["height"].append(get_pixel(x, z, i[2], image_scale))
+        course_json["userLayers"]["height"].append(get_pixel(x, z, elevation, image_scale))
 
-    if options_dict.get('lidar_trees', False) and len(read_dictionary.get('trees', [])) > 0:
+    lidar_trees = heightmap_file.trees()
+    if options_dict.get('lidar_trees', False) and len(lidar_trees) > 0:
         printf("Adding trees from lidar data")
         # Need separate mask geopointcloud because pc is cropped
         mask_pc = GeoPointCloud()
-        mask_pc.addFromImage(im, image_scale, read_dictionary['origin'], read_dictionary['projection'])
-        for o in get_lidar_trees(course_json['theme'], options_dict.get('tree_variety', False), read_dictionary['trees'], pc, mask, mask_pc, image_scale):
+        mask_pc.addFromImage(im, image_scale, origin, heightmap_file.projection)
+        for o in get_lidar_trees(course_json['theme'], options_dict.get('tree_variety', False), lidar_trees, pc, mask, mask_pc, image_scale):
             course_json["placedObjects2"].append(o)
 
     # Download OpenStreetMaps Data for this smaller area
@@ -11,9 +11,10 @@ import tgc_definitions
 import tgc_tools
 
 def drawBrushesOnImage(brushes, color, im, pc, image_scale, fill=True):
-    for brush in brushes:
-        center = pc.tgcToCV2(brush["position"]["x"], brush["position"]["z"], image_scale)
-        center = (center[1], center[0]) # In point coordinates, not pixel
+    # Convert every brush position at once
+    rows, columns = pc.tgcToCV2Array([brush["position"]["x"] for brush in brushes], [brush["position"]["z"] for brush in brushes], image_scale)
+    for brush, row, column in zip(brushes, rows, columns):
+        center = (int(column), int(row)) # In point coordinates, not pixel
         width = brush["scale"]["x"] / image_scale
         height = brush["scale"]["z"] / image_scale
         rotation = - brush["rotation"]["y"] # Inverted degrees, cv2 bounding_box uses degrees
@@ -41,18 +42,15 @@ def drawBrushesOnImage(brushes, color, im, pc, image_scale, fill=True):
 
 def drawSplinesOnImage(splines, color, im, pc, image_scale):
     for s in splines:
-        # Get the shape of this spline and draw it on the image
-        nds = []
-        for wp in s["waypoints"]:
-            nds.append(pc.tgcToCV2(wp["waypoint"]["x"], wp["waypoint"]["y"], image_scale))
-
         # Don't try to draw malformed splines
-        if len(nds) == 0:
+        if len(s["waypoints"]) == 0:
             continue
 
+        # Get the shape of this spline and draw it on the image
+        rows, columns = pc.tgcToCV2Array([wp["waypoint"]["x"] for wp in s["waypoints"]], [wp["waypoint"]["y"] for wp in s["waypoints"]], image_scale)
+
         # Uses points and not image pixels, so flip the x and y
-        nds = np.array(nds)
-        nds[:,[0, 1]] = nds[:,[1, 0]]
+        nds = np.column_stack((columns, rows))
         nds = np.int32([nds]) # Bug with fillPoly, needs explict cast to 32bit
 
         thickness = int(s["width"])
@@ -101,21 +99,14 @@ def drawObjectsOnImage(objects, color, im, pc, image_scale):
 def drawHolesOnImage(holes, color, im, pc, image_scale):
     for h in holes:
         # Get the shape of this spline and draw it on the image
-        waypoints = []
-        for wp in h["waypoints"]:
-            waypoints.append(pc.tgcToCV2(wp["x"], wp["z"], image_scale))
-
-        tees = []
-        for t in h["teePositions"]:
-            tees.append(pc.tgcToCV2(t["x"], t["z"], image_scale))
+        waypoint_rows, waypoint_columns = pc.tgcToCV2Array([wp["x"] for wp in h["waypoints"]], [wp["z"] for wp in h["waypoints"]], image_scale)
+        tee_rows, tee_columns = pc.tgcToCV2Array([t["x"] for t in h["teePositions"]], [t["z"] for t in h["teePositions"]], image_scale)
 
         # Going to skip drawing pinPositions due to low resolution
 
         # Uses points and not image pixels, so flip the x and y
-        waypoints = np.array(waypoints)
-        waypoints[:,[0, 1]] = waypoints[:,[1, 0]]
-        tees = np.array(tees)
-        tees[:,[0, 1]] = tees[:,[1, 0]]
+        waypoints = np.column_stack((waypoint_columns, waypoint_rows)).tolist()
+        tees = np.column_stack((tee_columns, tee_rows)).tolist()
 
         # Draw a line between each waypoint
         thickness = 5
@@ -1,3 +1,5 @@
+import collections
+import concurrent.futures
 from difflib import SequenceMatcher
 import itertools
 import json
@@ -6,13 +8,28 @@ import math
 import numpy
 import os
 from pathlib import Path
+import struct
 import xml.etree.ElementTree as ET
 
 import pyproj
 
 from GeoPointCloud import *
-
-def get_unit_multiplier_from_epsg(epsg):
+import ingest_cache
+
+reproject_chunk_size = 1000000 # Number of points re-projected at a time
+
+# Converts coordinate arrays from src_proj to dst_proj in place
+# Works on chunks so that large files don't need another full copy of their coordinates
+def reproject_points(src_proj, dst_proj, x, y, z, chunk_size=None):
+    if chunk_size is None:
+        chunk_size = reproject_chunk_size
+    transform = get_transformer(src_proj, dst_proj)
+    for start in range(0, len(x), chunk_size):
+        end = start + chunk_size
+        x[start:end], y[start:end], z[start:end] = transform(x[start:end], y[start:end], z[start:end])
+    return x, y, z
+
+def _compute_unit_multiplier_from_epsg(epsg):
     # Can't find any lightweight way to do this, but I depend heavily on pyproj right now
     # Until there's a better way, get the unit by converting (1,0) from 'unit' to 'meter'
     meter_proj = pyproj.Proj(init='epsg:'+str(epsg), preserve_units=False) # Forces meter
@@ -25,11 +42,9 @@ def get_unit_multiplier_from_epsg(epsg):
         return x2/scale_value
     except:
         pass
-    return 0.0
+    return None # Couldn't be determined
 
-# Some of the epsgs found in lidar files don't represent projected coordinate systems
-# but are instead the datum or other geographic reference systems
-def is_epsg_datum(epsg):
+def _compute_is_epsg_datum(epsg):
     # It looks like these are all in the 4000 to 42NN range.
     # I can't determine which are valid, so I'm going to convert from meters to degrees
     # If it's degrees to degrees, it won't modify the number
@@ -42,7 +57,54 @@ def is_epsg_datum(epsg):
         return math.isclose(scale_value, x2, abs_tol=1.0) # Should be very different
     except:
         pass
-    return True # Invalidate this EPSG if it can't be determined or used
+    return None # Couldn't be determined
+
+# Resolving an EPSG code builds several projections and runs test transforms
+# Every GeoKey of every file asks about EPSG codes, so remember the answers for the whole process
+# Maps str(epsg) to a dictionary with 'datum', 'unit' and 'valid' entries that can be saved as json
+# Answers that came from an error are marked 'fallback', the error may not happen next time so they are only kept for this process
+_epsg_cache = {}
+_epsg_projs = {} # Projection objects can't be saved as json, keep them separately
+_loaded_epsg_cache_files = set()
+
+def _resolve_epsg(epsg):
+    key = str(epsg)
+    info = _epsg_cache.get(key)
+    if info is None:
+        try:
+            info = {'valid': True, 'datum': _compute_is_epsg_datum(epsg)}
+            if info['datum'] is None:
+                # Invalidate this EPSG if it can't be determined or used
+                info = {'valid': True, 'datum': True, 'fallback': True}
+        except Exception:
+            # pyproj doesn't know this code at all
+            info = {'valid': False, 'fallback': True}
+        _epsg_cache[key] = info
+    if not info['valid']:
+        raise ValueError("Unknown EPSG: " + key)
+    return info
+
+def get_unit_multiplier_from_epsg(epsg):
+    info = _resolve_epsg(epsg)
+    if 'unit' not in info:
+        info['unit'] = _compute_unit_multiplier_from_epsg(epsg)
+        if info['unit'] is None:
+            info['unit'] = 0.0
+            info['fallback'] = True
+    return info['unit']
+
+# Some of the epsgs found in lidar files don't represent projected coordinate systems
+# but are instead the datum or other geographic reference systems
+def is_epsg_datum(epsg):
+    return _resolve_epsg(epsg)['datum']
+
+def get_proj_from_epsg(epsg):
+    key = str(epsg)
+    proj = _epsg_projs.get(key)
+    if proj is None:
+        proj = pyproj.Proj(init='epsg:'+key)
+        _epsg_projs[key] = proj
+    return proj
 
 def proj_from_epsg(epsg, printf=print):
     if is_epsg_datum(epsg):
@@ -51,11 +113,43 @@ def proj_from_epsg(epsg, printf=print):
         return None, 0.0
     if epsg is not None:
         printf("Overwriting projection with EPSG:" + str(epsg))
-        proj = pyproj.Proj(init='epsg:'+str(epsg))
+        proj = get_proj_from_epsg(epsg)
         unit = get_unit_multiplier_from_epsg(epsg)
         return (proj, unit)
     return None, 0.0
 
+# Optionally keep resolved EPSG codes on disk between runs
+# Results are only reused with the same pyproj version that produced them
+def load_epsg_cache(path):
+    if path is None or path in _loaded_epsg_cache_files:
+        return
+    _loaded_epsg_cache_files.add(path)
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('pyproj') == pyproj.__version__:
+            for key, info in data.get('epsg', {}).items():
+                _epsg_cache.setdefault(key, info)
+    except (OSError, ValueError):
+        # Missing or unreadable cache, codes will be resolved again
+        pass
+
+# Written to a temporary file first so a crash or another run saving at the same time can't leave half of a file
+def save_epsg_cache(path):
+    if path is None:
+        return
+    resolved = {key: info for key, info in _epsg_cache.items() if not info.get('fallback', False)}
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'pyproj': pyproj.__version__, 'epsg': resolved}, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
 def convert_latlon_to_utm_espg(lat, lon):
     utm_band = str((math.floor((lon + 180) / 6 ) % 60) + 1)
     if len(utm_band) == 1:
@@ -66,14 +160,147 @@ def convert_latlon_to_utm_espg(lat, lon):
         epsg_code = '327' + utm_band
     return int(epsg_code)
 
+# Returns the (min, max) corners of a region of interest in proj coordinates
+# The edges are sampled since straight lines in one projection can bend in another
+def roi_bounds_in_proj(roi, roi_proj, proj, samples=8):
+    lower_left, upper_right = roi
+    if roi_proj is None:
+        # Lat/lon corners, swap to lon, lat order
+        roi_proj = pyproj.Proj(proj='latlong', datum='WGS84')
+        lower_left = (lower_left[1], lower_left[0])
+        upper_right = (upper_right[1], upper_right[0])
+
+    if roi_proj.srs == proj.srs:
+        return lower_left, upper_right
+
+    edge = numpy.linspace(0.0, 1.0, samples)
+    xs = numpy.concatenate([lower_left[0] + edge*(upper_right[0] - lower_left[0]), numpy.full(samples, upper_right[0]), \
+                            upper_right[0] - edge*(upper_right[0] - lower_left[0]), numpy.full(samples, lower_left[0])])
+    ys = numpy.concatenate([numpy.full(samples, lower_left[1]), lower_left[1] + edge*(upper_right[1] - lower_left[1]), \
+                            numpy.full(samples, upper_right[1]), upper_right[1] - edge*(upper_right[1] - lower_left[1])])
+    xs, ys = get_transformer(roi_proj, proj)(xs, ys)
+    return (numpy.min(xs), numpy.min(ys)), (numpy.max(xs), numpy.max(ys))
+
 def print_failure_message(printf=print):
     printf("Could not determine lidar projection, please report an issue and send this lidar and metadata")
     printf("Alternatively, look for something called EPSG Value in Metadata and provide EPSG.")
     return None
 
-def load_usgs_directory(d, force_epsg=None, force_unit=None, printf=print):
-    pc = GeoPointCloud()
+# Projection tags read from metadata xmls
+metadata_tags = ['utmzone', 'semiaxis', 'denflat', 'sfctrmer', 'feast', 'fnorth', 'longcm', 'latprjo']
+
+def read_metadata_xml(xml):
+    root = ET.parse(xml).getroot()
+
+    metadata = {'unit': "Unknown"}
+    for un in itertools.chain(root.iter('plandu'), root.iter('altunits')):
+        try:
+            metadata['unit'] = un.text.strip() # Some xmls have padded whitespace
+        except:
+            pass
+
+    # Keep the text of the last matching tag, converted when used
+    for tag in metadata_tags:
+        metadata[tag] = None
+        for t in root.iter(tag):
+            metadata[tag] = t.text
+    return metadata
 
+def metadata_float(metadata, tag, scale=1.0):
+    if metadata[tag] is None:
+        return None
+    return float(metadata[tag])*scale
+
+# Parsed metadata for each xml path, shared by every index in this process
+_metadata_xmls = {}
+
+# Finds and reads the metadata xmls in a lidar directory
+# Each xml is parsed at most once no matter how many lidar files use it
+class MetadataIndex:
+    def __init__(self, d):
+        self.xmls = list(Path(d).glob('*.xml'))
+        self._matches = {}
+
+        # Most deliveries name the metadata after the lidar file
+        # Map both tile.xml and tile.laz.xml to tile
+        self._stems = {}
+        for x in self.xmls:
+            stem = x.stem.lower()
+            for ext in ['.las', '.laz']:
+                if stem.endswith(ext):
+                    stem = stem[:-len(ext)]
+            self._stems.setdefault(stem, x)
+
+    # Returns the xml path that best matches a lidar filename, or None
+    def find(self, filename):
+        if filename not in self._matches:
+            xml = self._stems.get(os.path.splitext(filename)[0].lower())
+            if xml is None:
+                xml = self._closest_match(filename)
+            self._matches[filename] = xml
+        return self._matches[filename]
+
+    # Find the XML file with the name closest matching to the las/laz
+    def _closest_match(self, filename):
+        highest_match = 0.0
+        xml = None
+        for x in self.xmls:
+            matcher = SequenceMatcher(None, str(filename), str(x))
+            # The quick ratios are upper bounds, skip the full comparison when it can't win
+            if matcher.real_quick_ratio() <= highest_match or matcher.quick_ratio() <= highest_match:
+                continue
+            score = matcher.ratio()
+            if score > highest_match:
+                highest_match = score
+                xml = x
+        return xml
+
+    def fields(self, xml):
+        key = str(xml)
+        if key not in _metadata_xmls:
+            _metadata_xmls[key] = read_metadata_xml(xml)
+        return _metadata_xmls[key]
+
+# Reads the number of points from a las or laz header without decompressing the file
+def read_las_point_count(path):
+    with open(path, 'rb') as f:
+        header = f.read(255)
+    count = struct.unpack_from('<I', header, 107)[0] # Legacy number of point records
+    if header[25] >= 4 and len(header) >= 255:
+        # LAS 1.4 can have more points than fit in the legacy field
+        count = max(count, struct.unpack_from('<Q', header, 247)[0])
+    return count
+
+# Reads the bounds and projection records from a las or laz header without decompressing the file
+# Returns a dictionary of 'min' and 'max' (x, y, z) in file units and 'vlrs', the bodies of the variable length records
+# The GeoTIFF key directory and double parameters are unpacked like laspy's parsed_body, other records are None
+def read_las_header(path):
+    with open(path, 'rb') as f:
+        header = f.read(227)
+        if len(header) < 227 or header[:4] != b'LASF':
+            raise ValueError(path + " is not a las or laz file")
+        header_size = struct.unpack_from('<H', header, 94)[0]
+        num_vlrs = struct.unpack_from('<I', header, 100)[0]
+        max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from('<6d', header, 179)
+
+        vlrs = []
+        f.seek(header_size)
+        for i in range(num_vlrs):
+            vlr_header = f.read(54)
+            if len(vlr_header) < 54:
+                break
+            user_id = vlr_header[2:18].split(b'\x00', 1)[0]
+            record_id, record_length = struct.unpack_from('<HH', vlr_header, 18)
+            body = f.read(record_length)
+            parsed_body = None
+            if user_id == b'LASF_Projection' and record_id == 34735:
+                parsed_body = struct.unpack('<' + str(len(body)//2) + 'H', body[:len(body)//2*2])
+            elif user_id == b'LASF_Projection' and record_id == 34736:
+                parsed_body = struct.unpack('<' + str(len(body)//8) + 'd', body[:len(body)//8*8])
+            vlrs.append(parsed_body)
+    return {'min': (min_x, min_y, min_z), 'max': (max_x, max_y, max_z), 'vlrs': vlrs}
+
+def add_laszip_to_path():
     # Add current directory to os path to find laszip-cli for laz files
     os.environ["PATH"] += os.pathsep + os.getcwd()
     # Add ./laszip
@@ -81,193 +308,363 @@ def load_usgs_directory(d, force_epsg=None, force_unit=None, printf=print):
     # Add {this_file_location}/laszip for Pyinstaller temp directories
     os.environ["PATH"] += os.pathsep + os.path.dirname(os.path.realpath(__file__)) + os.sep + 'laszip'
 
-    for filename in os.listdir(d):
-        # Only parse laz and las files
-        if not filename.endswith('.laz') and not filename.endswith('.las'): continue
+def get_lidar_filenames(d):
+    # Only parse laz and las files
+    return [filename for filename in os.listdir(d) if filename.endswith('.laz') or filename.endswith('.las')]
+
+# Reads a single las or laz file and determines its projection
+# Returns a dictionary with the scaled coordinates and projection, or None if the projection could not be determined
+# roi is an optional region of interest as (lower_left, upper_right) corners, files outside it are skipped and files crossing it are cropped
+# The corners are (lat, lon) degrees, or (easting, northing) in roi_proj when it is provided
+def read_usgs_file(d, filename, force_epsg=None, force_unit=None, metadata_index=None, roi=None, roi_proj=None, printf=print):
+    printf("Processing: " + filename)
+
+    # Projection and bounds come from the header, so files outside of the region of interest are never decompressed
+    header = read_las_header(d+"/"+filename)
+
+    # Needed from metadata for all files
+    proj = None
+    unit = 0.0 # Don't assume unit
+    default_proj = None # Projection to use for the whole pointcloud if this file is in geographic coordinates
+
+    if force_epsg is not None:
+        proj, unit = proj_from_epsg(force_epsg, printf=printf)
+
+    # Try to get projection data from the lidar file
+    for parsed_body in header['vlrs']:
+        # Look for GEOTIFF tags or something?  This is a list of values and EPSG codes
+        if proj is None and parsed_body is not None and len(parsed_body) > 3:
+            try:
+                num_records = parsed_body[3]
+                for i in range(0, num_records):
+                    key = parsed_body[4 + 4*i]
+                    value_offset = parsed_body[7 + 4*i]
+                    try:
+                        proj, unit = proj_from_epsg(value_offset, printf=printf)
+                        if proj is not None:
+                            printf("Found EPSG from lidar file: " + str(value_offset))
+                            break
+                    except:
+                        pass
+            except:
+                pass
+
+        # Projection coordinates list
+        if proj is None and parsed_body and len(parsed_body) == 10:
+            # (0.0, 500000.0, 0.0, -75.0, 0.9996, 1.0, 6378137.0, 298.2572221010042, 0.0, 0.017453292519943278)
+            # pyproj.Proj('+proj=tmerc +datum=NAD83 +ellps=GRS80 +a=6378137.0 +f=298.2572221009999 +k=0.9996 +x_0=500000.0 +y_0=0.0 +lon_0=-75.0 +lat_0=0.0 +units=m +axis=enu ', preserve_units=True)
+            try:
+                sys = 'tmerc' # Don't think any other format is used
+                datum = 'NAD83'
+                ellips = 'GRS80' # Assume this for now, can't find any evidence another is used for lidar
+                proj = pyproj.Proj(proj=sys, datum=datum, ellps=ellips, a=parsed_body[6], f=parsed_body[7], k=parsed_body[4], \
+                                   x_0=parsed_body[1], y_0=parsed_body[0], lon_0=parsed_body[3], lat_0=parsed_body[2], units='m', axis='enu')
+                unit = parsed_body[5]
+                printf("Found Projection parameters from lidar file")
+            except:
+                pass
+
+    # Wasn't in the las files, do the difficult search in metadata xmls
+    if proj is None:
+        if metadata_index is None:
+            metadata_index = MetadataIndex(d)
+        xml = metadata_index.find(filename)
+
+        if xml is None:
+            printf("Could not find metadata for " + filename + ".")
+        else:
+            printf("Using metadata: " + xml.name)
+            metadata = metadata_index.fields(xml)
+
+            # If unit not in CRS, try to find it in a tag
+            if unit == 0.0:
+                unit_name = metadata['unit']
+                if unit_name == 'meters':
+                    unit = 1.0
+                elif unit_name == 'Foot_US':
+                    unit = 1200.0/3937.0
+                elif unit_name == 'foot': # International Foot
+                    unit = 0.3048
+                else:
+                    return print_failure_message(printf=printf)
 
-        printf("Processing: " + filename)
+            # Continue to look for Metadata
+            if proj is None:
+                # Try to find a UTM zone.
+                utm_zone = metadata_float(metadata, 'utmzone')
+
+                if utm_zone is not None:
+                    printf("Found UTM Zone from metadata file")
+                    proj = pyproj.Proj(proj='utm', datum='WGS84', ellps='WGS84', zone=utm_zone, units='m')
+
+            # Continue to look for Metadata
+            # This last method is the least reliable because the metadata could be hand generated and inconsistent
+            if proj is None:
+                sys = 'tmerc' # Don't think this newer metadata format uses another system
+                datum = 'NAD83'
+                ellips = 'GRS80' # Assume this for now, can't find any evidence another is used for lidar
+                semiaxis = metadata_float(metadata, 'semiaxis')
+                denflat = metadata_float(metadata, 'denflat')
+                sfctrmer = metadata_float(metadata, 'sfctrmer')
+                feast = metadata_float(metadata, 'feast', unit) # Scale into meters
+                fnorth = metadata_float(metadata, 'fnorth', unit) # Scale into meters
+                meridian = metadata_float(metadata, 'longcm')
+                latprj = metadata_float(metadata, 'latprjo')
+
+                if not None in [semiaxis, denflat, sfctrmer, feast, fnorth, meridian, latprj]:
+                    printf("Found Projection Parameters from metadata file")
+                    proj = pyproj.Proj(proj=sys, datum=datum, ellps=ellips, a=semiaxis, f=denflat, k=sfctrmer, x_0=feast, y_0=fnorth, lon_0=meridian, lat_0=latprj, units='m', axis='enu')
+
+    # Rarely the files come in with lat and lon coordinates, need to convert these to UTM
+    if proj is None:
+        if header['max'][0] - header['min'][0] < 2.0 and header['max'][1] - header['min'][1] < 2.0:
+            # Such small difference between units, probably in geographic coordinates
+            printf("File is likely in Geographic Coordinates (Lat/Lon Degrees).  You probably want to find alternate files, but we will try to project this for you.")
+
+            center = ((header['max'][1] + header['min'][1])/2.0, (header['max'][0] + header['min'][0])/2.0)
+            epsg = convert_latlon_to_utm_espg(center[0], center[1])
+            printf("For center coordinates: " + str(center) + ":")
+
+            # The pointcloud's projection will be set to the utm if nothing else is there yet
+            default_proj, utm_unit = proj_from_epsg(epsg, printf=printf)
+
+            # Set this units projection to coordinates and don't scale
+            proj = pyproj.Proj(proj='latlong',datum='WGS84')
+            unit = 1.0
+
+    if proj is None:
+        return print_failure_message(printf=printf)
+
+    # Need to overwrite unit last for situations where projection is not overwritten
+    if force_unit is not None:
+        unit = float(force_unit)
+
+    printf("Unit in use is " + str(unit))
+    printf("Proj4 : " + str(proj))
+
+    tile = {'proj': proj, 'default_proj': default_proj}
+
+    # Use the header bounds to avoid reading any points outside the region of interest
+    if roi is not None:
+        roi_min, roi_max = roi_bounds_in_proj(roi, roi_proj, proj)
+        header_min = (header['min'][0]*unit, header['min'][1]*unit)
+        header_max = (header['max'][0]*unit, header['max'][1]*unit)
+        if header_max[0] < roi_min[0] or header_min[0] > roi_max[0] or header_max[1] < roi_min[1] or header_min[1] > roi_max[1]:
+            printf("Outside of region of interest, skipping: " + filename)
+            for key, dtype in [('x', float), ('y', float), ('z', float), ('intensity', float), ('classification', int)]:
+                tile[key] = numpy.empty(0, dtype)
+            return tile
+
+    # Use laspy to load the point data
+    with laspy.file.File(d+"/"+filename, mode='r') as f:
+        keep = None
+        if roi is not None and (header_min[0] < roi_min[0] or header_max[0] > roi_max[0] or header_min[1] < roi_min[1] or header_max[1] > roi_max[1]):
+            # Partially covered, crop after scaling
+            x = f.x*unit
+            y = f.y*unit
+            keep = numpy.logical_and(numpy.logical_and(roi_min[0] <= x, x <= roi_max[0]), numpy.logical_and(roi_min[1] <= y, y <= roi_max[1]))
+            tile['x'] = x[keep]
+            tile['y'] = y[keep]
+            del x, y
+
+        if keep is None:
+            tile['x'] = f.x*unit
+            tile['y'] = f.y*unit
+            tile['z'] = f.z*unit
+            tile['intensity'] = numpy.array(f.intensity)
+            tile['classification'] = numpy.array(f.classification).astype(int)
+        else:
+            tile['z'] = f.z[keep]*unit
+            tile['intensity'] = numpy.array(f.intensity)[keep]
+            tile['classification'] = numpy.array(f.classification)[keep].astype(int)
+    return tile
+
+# Worker processes can't print to the user interface, so messages are returned and printed in file order
+# Resolved EPSG codes are also returned so the caller can remember them
+def _read_usgs_file_worker(d, filename, read_options, epsg_cache_file):
+    load_epsg_cache(epsg_cache_file)
+    messages = []
+    try:
+        return messages, read_usgs_file(d, filename, printf=messages.append, **read_options), None, _epsg_cache
+    except Exception as e:
+        return messages, None, e, _epsg_cache
+
+# Yields (filename, tile, error) in directory order
+# With more than one worker, files are decoded in a process pool with a limited number of files in flight
+# read_options are passed to read_usgs_file
+def _read_usgs_files(d, filenames, read_options, workers=1, epsg_cache_file=None, printf=print):
+    read_options = dict(read_options)
+    read_options['metadata_index'] = MetadataIndex(d)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or len(filenames) <= 1:
+        for filename in filenames:
+            try:
+                yield filename, read_usgs_file(d, filename, printf=printf, **read_options), None
+            except Exception as e:
+                yield filename, None, e
+        return
+
+    printf("Reading lidar files with " + str(workers) + " processes")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        remaining = iter(filenames)
+        # Keep a couple files per worker queued so results don't pile up while waiting on a slow file
+        for filename in itertools.islice(remaining, 2*workers):
+            pending.append((filename, executor.submit(_read_usgs_file_worker, d, filename, read_options, epsg_cache_file)))
+
+        while pending:
+            filename, future = pending.popleft()
+            try:
+                messages, tile, error, epsg_cache = future.result()
+                for key, info in epsg_cache.items():
+                    _epsg_cache.setdefault(key, info)
+            except Exception as e:
+                # The worker process itself failed
+                messages, tile, error = [], None, e
+            for m in messages:
+                printf(m)
+            yield filename, tile, error
+
+            for next_filename in itertools.islice(remaining, 1):
+                pending.append((next_filename, executor.submit(_read_usgs_file_worker, d, next_filename, read_options, epsg_cache_file)))
+
+# Converts the points of a tile from read_usgs_file to the target projection in place
+# Returns the projection the points are now in, the first tile decides the target when there isn't one yet
+def project_usgs_tile(tile, target=None, printf=print):
+    proj = tile['proj']
+
+    # Use the utm projection if nothing else is there yet
+    if target is None and tile['default_proj'] is not None:
+        target = tile['default_proj']
+
+    # Check if coordinate projection needs converted
+    if not target:
+        # First dataset will set the coordinate system
+        target = proj
+    elif str(target) != str(proj):
+        printf("Warning: Data has different projection, re-projecting coordinates.")
+        reproject_points(proj, target, tile['x'], tile['y'], tile['z'])
+    return target
+
+def add_usgs_tile(pc, tile, printf=print):
+    pc.proj = project_usgs_tile(tile, pc.proj, printf=printf)
+    pc.addDataSet(tile['x'], tile['y'], tile['z'], tile['intensity'], tile['classification'])
+
+# Reads a file's points from the ingest cache
+# Returns the projection and columns, or None if they can't be used for the target projection
+def read_cached_file(cache_dir, filename, entry, target=None, printf=print):
+    # The cached points are only valid if they were converted to the projection in use
+    expected_target = ingest_cache.projection_key(target)
+    if expected_target is None:
+        expected_target = entry['default_proj'] or entry['proj']
+    if entry['target'] != expected_target:
+        return None
 
-        # Use laspy to load the point data
-        try:
-            with laspy.file.File(d+"/"+filename, mode='r') as f:
-                # Needed from metadata for all files
-                proj = None
-                unit = 0.0 # Don't assume unit
-
-                if force_epsg is not None:
-                    proj, unit = proj_from_epsg(force_epsg, printf=printf)
-
-                # Try to get projection data from laspy
-                for v in f.header.vlrs:
-                    # Look for GEOTIFF tags or something?  This is a list of values and EPSG codes
-                    if proj is None and v.parsed_body is not None and len(v.parsed_body) > 3:
-                        try:
-                            num_records = v.parsed_body[3]
-                            for i in range(0, num_records):
-                                key = v.parsed_body[4 + 4*i]
-                                value_offset = v.parsed_body[7 + 4*i]
-                                try:
-                                    proj, unit = proj_from_epsg(value_offset, printf=printf)
-                                    if proj is not None:
-                                        printf("Found EPSG from lidar file: " + str(value_offset))
-                                        break
-                                except:
-                                    pass
-                        except:
-                            pass
-
-                    # Projection coordinates list
-                    if proj is None and v.parsed_body and len(v.parsed_body) == 10:
-                        # (0.0, 500000.0, 0.0, -75.0, 0.9996, 1.0, 6378137.0, 298.2572221010042, 0.0, 0.017453292519943278)
-                        # pyproj.Proj('+proj=tmerc +datum=NAD83 +ellps=GRS80 +a=6378137.0 +f=298.2572221009999 +k=0.9996 +x_0=500000.0 +y_0=0.0 +lon_0=-75.0 +lat_0=0.0 +units=m +axis=enu ', preserve_units=True)
-                        try:
-                            sys = 'tmerc' # Don't think any other format is used
-                            datum = 'NAD83'
-                            ellips = 'GRS80' # Assume this for now, can't find any evidence another is used for lidar
-                            proj = pyproj.Proj(proj=sys, datum=datum, ellps=ellips, a=v.parsed_body[6], f=v.parsed_body[7], k=v.parsed_body[4], \
-                                               x_0=v.parsed_body[1], y_0=v.parsed_body[0], lon_0=v.parsed_body[3], lat_0=v.parsed_body[2], units='m', axis='enu')
-                            unit = v.parsed_body[5]
-                            printf("Found Projection parameters from lidar file")
-                        except:
-                            pass
-
-                # Wasn't in the las files, do the difficult search in metadata xmls
-                if proj is None:
-                    # Find the XML file with the name closest matching to the las/laz
-                    highest_match = 0.0
-                    xml = None
-                    for x in list(Path(d).glob('*.xml')):
-                        score = SequenceMatcher(None, str(filename), str(x)).ratio()
-                        if score > highest_match:
-                            highest_match = score
-                            xml = x
-
-                    if xml is None:
-                        printf("Could not find metadata for " + filename + ".")
-                    else:
-                        printf("Using metadata: " + xml.name)
-                        tree = ET.parse(xml)
-                        root = tree.getroot()
-
-                        # If unit not in CRS, try to find it in a tag
-                        if unit == 0.0:
-                            unit_name = "Unknown"
-                            for un in itertools.chain(root.iter('plandu'), root.iter('altunits')):
-                                try:
-                                    unit_name = un.text.strip() # Some xmls have padded whitespace
-                                except:
-                                    pass
-
-                            if unit_name == 'meters':
-                                unit = 1.0
-                            elif unit_name == 'Foot_US':
-                                unit = 1200.0/3937.0
-                            elif unit_name == 'foot': # International Foot
-                                unit = 0.3048
-                            else:
-                                return print_failure_message(printf=printf)
-
-                        # Continue to look for Metadata
-                        if proj is None:
-                            # Try to find a UTM zone.
-                            utm_zone = None
-                            for uz in root.iter('utmzone'):
-                                utm_zone = float(uz.text)
-
-                            if utm_zone is not None:
-                                printf("Found UTM Zone from metadata file")
-                                proj = pyproj.Proj(proj='utm', datum='WGS84', ellps='WGS84', zone=utm_zone, units='m')
-
-                        # Continue to look for Metadata
-                        # This last method is the least reliable because the metadata could be hand generated and inconsistent
-                        if proj is None:
-                            sys = 'tmerc' # Don't think this newer metadata format uses another system
-                            datum = 'NAD83'
-                            ellips = 'GRS80' # Assume this for now, can't find any evidence another is used for lidar
-                            semiaxis = None
-                            for sa in root.iter('semiaxis'):
-                                semiaxis = float(sa.text)
-                            denflat = None
-                            for df in root.iter('denflat'):
-                                denflat = float(df.text)
-                            sfctrmer = None
-                            for sfc in root.iter('sfctrmer'):
-                                sfctrmer = float(sfc.text)
-                            feast = None
-                            for fe in root.iter('feast'):
-                                feast = float(fe.text)*unit # Scale into meters
-                            fnorth = None
-                            for fn in root.iter('fnorth'):
-                                fnorth = float(fn.text)*unit # Scale into meters
-                            meridian = None
-                            for m in root.iter('longcm'):
-                                meridian = float(m.text)
-                            latprj = None
-                            for l in root.iter('latprjo'):
-                                latprj = float(l.text)
-
-                            if not None in [semiaxis, denflat, sfctrmer, feast, fnorth, meridian, latprj]:
-                                printf("Found Projection Parameters from metadata file")
-                                proj = pyproj.Proj(proj=sys, datum=datum, ellps=ellips, a=semiaxis, f=denflat, k=sfctrmer, x_0=feast, y_0=fnorth, lon_0=meridian, lat_0=latprj, units='m', axis='enu')
-
-                # Rarely the files come in with lat and lon coordinates, need to convert these to UTM
-                if proj is None:
-                    if f.header.max[0] - f.header.min[0] < 2.0 and f.header.max[1] - f.header.min[1] < 2.0:
-                        # Such small difference between units, probably in geographic coordinates
-                        printf("File is likely in Geographic Coordinates (Lat/Lon Degrees).  You probably want to find alternate files, but we will try to project this for you.")
-
-                        center = ((f.header.max[1] + f.header.min[1])/2.0, (f.header.max[0] + f.header.min[0])/2.0)
-                        epsg = convert_latlon_to_utm_espg(center[0], center[1])
-                        printf("For center coordinates: " + str(center) + ":")
-
-                        utm_proj, utm_unit = proj_from_epsg(epsg, printf=printf)
-
-                        # Set the pointcloud's projection to the utm if nothing else is there yet
-                        if pc.proj is None:
-                            pc.proj = utm_proj
-
-                        # Set this units projection to coordinates and don't scale
-                        proj = pyproj.Proj(proj='latlong',datum='WGS84')
-                        unit = 1.0
-
-                if proj is None:
-                    return print_failure_message(printf=printf)
+    try:
+        columns = ingest_cache.read_columns(cache_dir, filename)
+    except (OSError, ValueError):
+        return None
 
-                # Need to overwrite unit last for situations where projection is not overwritten
-                if force_unit is not None:
-                    unit = float(force_unit)
-
-                printf("Unit in use is " + str(unit))
-                printf("Proj4 : " + str(proj))
-
-                scaled_x = f.x*unit
-                scaled_y = f.y*unit
-                scaled_z = f.z*unit
-
-                converted_x = scaled_x
-                converted_y = scaled_y
-                converted_z = scaled_z
-
-                # Check if coordinate projection needs converted
-                if not pc.proj:
-                    # First dataset will set the coordinate system
-                    pc.proj = proj
-                elif str(pc.proj) != str(proj):
-                    printf("Warning: Data has different projection, re-projecting coordinates.  This may take some time.")
-                    
-                    converted_x = []
-                    converted_y = []
-                    converted_z = []
-
-                    for x, y, z in zip(scaled_x, scaled_y, scaled_z):
-                        x2, y2, z2 = pyproj.transform(proj, pc.proj, x, y, z)
-                        converted_x.append(x2)
-                        converted_y.append(y2)
-                        converted_z.append(z2)
-
-                pc.addDataSet(numpy.array(converted_x), numpy.array(converted_y), numpy.array(converted_z), numpy.array(f.intensity), numpy.array(f.classification).astype(int))
-        except:
-            printf("Could not load " + filename + " Please report this issue.")
+    printf("Using cached points for: " + filename)
+    if target is None:
+        target = pyproj.Proj(entry['target'])
+    return target, columns
+
+# Yields the projection and the x, y, z, intensity, classification columns of each lidar file as it is loaded
+# Every file is converted to the projection of the first one, so the projection is always the same
+# Yields None and stops if the projection of a file can't be determined
+# See load_usgs_directory for the options
+def iterate_usgs_directory(d, force_epsg=None, force_unit=None, workers=1, epsg_cache_file=None, roi=None, roi_proj=None, cache_dir=None, printf=print):
+    add_laszip_to_path()
+    load_epsg_cache(epsg_cache_file)
+
+    read_options = {'force_epsg': force_epsg, 'force_unit': force_unit, 'roi': roi, 'roi_proj': roi_proj}
+    filenames = get_lidar_filenames(d)
+
+    # Find the files that haven't changed since they were cached
+    manifest = None
+    fingerprints = {}
+    cached = {}
+    if cache_dir is not None:
+        manifest = ingest_cache.load_manifest(cache_dir)
+        for filename in filenames:
+            try:
+                fingerprints[filename] = ingest_cache.file_fingerprint(d+"/"+filename, **read_options)
+            except OSError:
+                continue
+            entry = ingest_cache.find_entry(manifest, filename, fingerprints[filename])
+            if entry is not None:
+                cached[filename] = entry
+
+    target = None
+    tiles = _read_usgs_files(d, [f for f in filenames if f not in cached], read_options, workers=workers, epsg_cache_file=epsg_cache_file, printf=printf)
+    try:
+        for filename in filenames:
+            if filename in cached:
+                result = read_cached_file(cache_dir, filename, cached[filename], target, printf=printf)
+                if result is not None:
+                    target = result[0]
+                    yield result
+                    continue
+                # Cached for a different projection, read it again
+                filename, tile, error = next(_read_usgs_files(d, [filename], read_options, epsg_cache_file=epsg_cache_file, printf=printf))
+            else:
+                filename, tile, error = next(tiles)
+
+            if error is None and tile is None:
+                # Projection could not be determined, failure was already printed
+                yield None
+                return
+
+            if error is not None:
+                printf("Could not load " + filename + " Please report this issue.")
+                continue
+
+            try:
+                target = project_usgs_tile(tile, target, printf=printf)
+            except:
+                printf("Could not load " + filename + " Please report this issue.")
+                continue
+
+            columns = [tile['x'], tile['y'], tile['z'], tile['intensity'], tile['classification']]
+            if manifest is not None and filename in fingerprints:
+                ingest_cache.write_columns(cache_dir, manifest, filename, fingerprints[filename], columns, tile['proj'], tile['default_proj'], target)
+            yield target, columns
+    finally:
+        # Also runs if the caller stops early, closing the files stops their worker processes
+        tiles.close()
+        save_epsg_cache(epsg_cache_file)
+        if manifest is not None:
+            ingest_cache.save_manifest(cache_dir, manifest)
+
+# workers is the number of processes used to read files, None uses every core
+# epsg_cache_file is an optional json file to remember resolved EPSG codes between runs
+# roi and roi_proj limit the points to a region of interest, see read_usgs_file
+# cache_dir optionally keeps the loaded points of each file so unchanged files aren't decoded again
+def load_usgs_directory(d, force_epsg=None, force_unit=None, workers=1, epsg_cache_file=None, roi=None, roi_proj=None, cache_dir=None, printf=print):
+    pc = GeoPointCloud()
+
+    # Allocate the whole pointcloud up front so adding files doesn't copy the points loaded so far
+    # A region of interest usually keeps a small part of the files, so let it grow as needed instead
+    if roi is None:
+        total_points = 0
+        for filename in get_lidar_filenames(d):
+            try:
+                total_points += read_las_point_count(d+"/"+filename)
+            except (OSError, struct.error):
+                pass
+        pc.reserve(total_points)
+
+    for result in iterate_usgs_directory(d, force_epsg=force_epsg, force_unit=force_unit, workers=workers, epsg_cache_file=epsg_cache_file, \
+                                         roi=roi, roi_proj=roi_proj, cache_dir=cache_dir, printf=printf):
+        if result is None:
+            return None
+        pc.proj, columns = result
+        pc.addDataSet(*columns)
+    pc.trim()
 
     if not pc.count:
         printf("No valid lidar files found, no action taken")
@@ -276,4 +673,4 @@ def load_usgs_directory(d, force_epsg=None, force_unit=None, printf=print):
 
     pc.computeOrigin()
     pc.removeBias()
-    return pc
\ No newline at end of file
+    return pc